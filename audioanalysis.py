@@ -0,0 +1,276 @@
+import os
+import struct
+import hashlib
+import tempfile
+import subprocess
+
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+from pydub.utils import mediainfo, mediainfo_json
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None  # Tags are read with ffprobe instead
+
+# Per file analysis for find_duplicate_audio_files.py.  A track is decoded once and
+# that one decode gives its PCM hash, the stream details for AudioFileInfo and, if
+# wanted, its acoustic fingerprint.  Tags come from the container's headers with
+# mutagen, no decode needed.
+#
+# The decode is streamed (see PCMStream): PCM is read from an ffmpeg pipe, or from
+# the file for WAV, a chunk at a time and hashed as it arrives, so memory doesn't
+# grow with the length of the track.  The bytes are the ones pydub's
+# AudioSegment.from_file(path).raw_data used to hold, so the hashes are the same as
+# those already in the cache.
+
+ID3_FRAMES = {'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB', 'genre': 'TCON'}
+
+CHUNK_BYTES = 1024 * 1024  # PCM read at a time
+WAV_MAX_SUBCHUNKS = 10  # As pydub, which gives up on a WAV with more before its data
+
+# pydub's 8 bit PCM is unsigned in the file and signed in raw_data
+_U8_TO_S8 = bytes((b - 128) % 256 for b in range(256))
+# and its 24 bit samples get a sign byte in front of them
+_SIGN_BYTE = bytes(0xFF if b > 0x7F else 0 for b in range(256))
+
+
+class PCMStream:
+    """
+    The PCM of filepath in chunks, as AudioSegment.from_file(filepath).raw_data would
+    have it.  WAV files pydub can read itself are read straight from the file;
+    anything else is decoded by ffmpeg to the sample format pydub would pick from
+    ffprobe.  8 bit samples are made signed and 24 bit ones padded to 32 bits the way
+    pydub does it.  Iterating yields bytes; sample_width, frame_rate and channels
+    describe them.  Raises CouldntDecodeError when the file can't be decoded.
+    """
+    def __init__(self, filepath, chunk_bytes=CHUNK_BYTES):
+        self.filepath = filepath
+        self.chunk_bytes = chunk_bytes
+        self.wav = self._wav_layout() if filepath.lower().endswith('.wav') else None
+        if self.wav is not None:
+            channels, frame_rate, bits = self.wav[:3]
+            self.source_width = bits // 8
+        else:
+            channels, frame_rate, bits, self.acodec = self._probe()
+            self.source_width = bits // 8
+        self.channels = channels
+        self.frame_rate = frame_rate
+        self.sample_width = 4 if self.source_width == 3 else self.source_width
+
+    def _wav_layout(self):
+        # (channels, frame_rate, bits, data offset, data size) if pydub would read this
+        # WAV without ffmpeg, else None.  Follows pydub's extract_wav_headers.
+        try:
+            with open(self.filepath, 'rb') as f:
+                f.seek(12)
+                fmt = None
+                for _ in range(WAV_MAX_SUBCHUNKS):
+                    header = f.read(8)
+                    if len(header) < 8:
+                        return None
+                    chunk_id, size = header[:4], struct.unpack('<I', header[4:])[0]
+                    if chunk_id == b'data':
+                        break
+                    if chunk_id == b'fmt ' and fmt is None:
+                        if size < 16:
+                            return None
+                        fmt = struct.unpack('<HHIIHH', f.read(16))
+                        f.seek(size - 16, 1)
+                    else:
+                        f.seek(size, 1)
+                else:
+                    return None
+                if fmt is None or fmt[0] not in (1, 0xFFFE) or fmt[5] < 8:
+                    return None
+                return fmt[1], fmt[2], fmt[5], f.tell(), size
+        except OSError:
+            return None
+
+    def _probe(self):
+        # pydub's choice of output format, from the same ffprobe call it makes
+        info = mediainfo_json(self.filepath)
+        streams = [stream for stream in (info or {}).get('streams', []) if stream.get('codec_type') == 'audio']
+        if not streams:
+            raise CouldntDecodeError("No audio stream in " + self.filepath)
+        stream = streams[0]
+        # pydub's workaround for ffprobe saying lossy formats hold float samples
+        if stream.get('sample_fmt') == 'fltp' and stream.get('codec_name') in ['mp3', 'mp4', 'aac', 'webm', 'ogg']:
+            bits = 16
+        else:
+            bits = stream['bits_per_sample']
+        acodec = 'pcm_u8' if bits == 8 else 'pcm_s%dle' % bits
+        return int(stream['channels']), int(stream['sample_rate']), bits, acodec
+
+    def __iter__(self):
+        convert = self._convert()
+        if self.wav is not None:
+            chunks = self._read_wav()
+        else:
+            chunks = self._read_ffmpeg()
+        if convert is None:
+            yield from chunks
+            return
+        # Conversions work on whole samples, carry any partial one to the next chunk
+        rest = b''
+        for chunk in chunks:
+            chunk = rest + chunk
+            usable = len(chunk) - len(chunk) % self.source_width
+            rest = chunk[usable:]
+            yield convert(chunk[:usable])
+
+    def _convert(self):
+        if self.source_width == 1:
+            return lambda chunk: chunk.translate(_U8_TO_S8)
+        if self.source_width == 3:
+            return _pad_24_bit
+        return None
+
+    def _read_wav(self):
+        offset, size = self.wav[3:]
+        with open(self.filepath, 'rb') as f:
+            f.seek(offset)
+            while size > 0:
+                chunk = f.read(min(self.chunk_bytes, size))
+                if not chunk:
+                    return
+                size -= len(chunk)
+                yield chunk
+
+    def _read_ffmpeg(self):
+        # Raw output in the codec's own format, e.g. pcm_s16le -> s16le
+        command = [AudioSegment.converter, '-y', '-i', self.filepath, '-acodec', self.acodec, '-vn',
+                   '-f', self.acodec[len('pcm_'):], '-']
+        # stderr goes to a file, a full stderr pipe would stall ffmpeg mid stream
+        with tempfile.TemporaryFile() as errors:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+            produced = 0
+            try:
+                while True:
+                    chunk = process.stdout.read(self.chunk_bytes)
+                    if not chunk:
+                        break
+                    produced += len(chunk)
+                    yield chunk
+            finally:
+                process.stdout.close()
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+            if process.returncode != 0 or produced == 0:
+                errors.seek(0)
+                raise CouldntDecodeError("Decoding failed. ffmpeg returned error code: " + str(process.returncode)
+                                         + "\n\nOutput from ffmpeg/avlib:\n\n"
+                                         + errors.read().decode(errors='ignore'))
+
+
+def _pad_24_bit(chunk):
+    # pydub's 24 to 32 bit conversion: a sign byte first, then the three sample bytes
+    out = bytearray(len(chunk) // 3 * 4)
+    out[1::4] = chunk[0::3]
+    out[2::4] = chunk[1::3]
+    out[3::4] = chunk[2::3]
+    out[0::4] = chunk[2::3].translate(_SIGN_BYTE)
+    return bytes(out)
+
+
+def pcm_hash(filepath):
+    """blake2b of filepath's PCM, as hashlib.blake2b(AudioSegment.from_file(filepath).raw_data, digest_size=16)."""
+    hasher = hashlib.blake2b(digest_size=16)
+    for chunk in PCMStream(filepath):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class AudioFileInfo:
+    def __init__(self, title, artist, album, genre, bitrate, sample_rate, channels, duration, frame_count, format):
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.genre = genre
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration
+        self.frame_count = frame_count
+        self.format = format
+
+    def has_tags(self):
+        return any((self.title, self.artist, self.album, self.genre))
+
+
+def read_tags(filepath):
+    # Title, artist, album, genre and bitrate from the container's headers, without
+    # decoding any audio.  Missing values are None.
+    tags = dict.fromkeys(('title', 'artist', 'album', 'genre', 'bitrate'))
+    if mutagen is not None:
+        try:
+            audio_file = mutagen.File(filepath, easy=True)
+        except Exception:
+            audio_file = None
+        if audio_file is not None:
+            file_tags = audio_file.tags or {}
+            for name in ('title', 'artist', 'album', 'genre'):
+                # Formats without an easy interface (WAV, AIFF) keep raw ID3 frames
+                value = file_tags.get(name) or file_tags.get(ID3_FRAMES[name])
+                value = getattr(value, 'text', value)
+                tags[name] = str(value[0]) if value else None
+            tags['bitrate'] = getattr(audio_file.info, 'bitrate', None)
+    else:
+        # ffprobe reads the container too, it's just a process per file
+        try:
+            info = mediainfo(filepath)
+        except Exception:
+            return tags
+        # Vorbis comments come back in upper case
+        tag_values = {key.lower(): value for key, value in info.get('TAG', {}).items()}
+        for name in ('title', 'artist', 'album', 'genre'):
+            tags[name] = tag_values.get(name)
+        tags['bitrate'] = info.get('bit_rate')
+    return tags
+
+
+def analyse_audio(filepath, fingerprint=False):
+    """
+    Stream filepath's PCM once and return (PCM hash, AudioFileInfo, fingerprint).  The
+    fingerprint is only computed when asked for.  All three are None for a file that
+    can't be decoded.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    size = 0
+    try:
+        stream = PCMStream(filepath)
+        resampler = None
+        if fingerprint:
+            from audiofingerprint import Resampler
+            resampler = Resampler(stream.sample_width, stream.frame_rate, stream.channels)
+        for chunk in stream:
+            hasher.update(chunk)
+            size += len(chunk)
+            if resampler is not None:
+                resampler.add(chunk)
+    except Exception as e:
+        print("badfile " + str(e))
+        return None, None, None
+    frame_count = float(size // (stream.sample_width * stream.channels))
+    tags = read_tags(filepath)
+    audio_info = AudioFileInfo(tags['title'], tags['artist'], tags['album'], tags['genre'], tags['bitrate'],
+                               stream.frame_rate, stream.channels, frame_count / stream.frame_rate, frame_count,
+                               os.path.splitext(filepath)[1][1:].lower())
+    if resampler is None:
+        return hasher.hexdigest(), audio_info, None
+    from audiofingerprint import fingerprint as make_fingerprint
+    return hasher.hexdigest(), audio_info, make_fingerprint(resampler.samples())
+
+
+def print_audio_info(audio_info):
+    print("Title:", audio_info.title)
+    print("Artist:", audio_info.artist)
+    print("Album:", audio_info.album)
+    print("Genre:", audio_info.genre)
+    print("Bitrate:", audio_info.bitrate)
+    print("Sample Rate:", audio_info.sample_rate)
+    print("Channels:", audio_info.channels)
+    print("Duration:", audio_info.duration, "seconds")
+    print("Frame Count:", audio_info.frame_count)
+    print("Format:", audio_info.format)
@@ -0,0 +1,251 @@
+import base64
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Acoustic fingerprints for find_duplicate_audio_files.py, so the same recording at
+# another bitrate, in another codec or with silence trimmed from an edge still
+# matches when its PCM hash doesn't.
+#
+# The fingerprint is a constellation of spectral peaks: the loudest points of a mono
+# 11025 Hz spectrogram within a time/frequency neighbourhood.  Lossy codecs change
+# the quiet detail but keep those peaks.  Each peak is an anchor combined with pairs
+# of the peaks just after it into 42 bit sub-hashes of (f1, f2, f3, dt1, dt2), each
+# stored with the anchor's time.  Two files are the same recording when many of
+# their sub-hashes match at one consistent time offset, which also lines up copies
+# that start earlier or later.
+#
+# FingerprintIndex is an inverted index: every sub-hash of every file in one array
+# sorted by hash, so only files sharing sub-hashes are ever compared.
+
+SAMPLE_RATE = 11025
+FFT_SIZE = 2048  # 1024 frequency bins of 5.4 Hz
+HOP = 512  # 46 ms frames
+PEAK_FREQ = 30  # A peak is the loudest point within this many bins
+PEAK_TIME = 20  # and this many frames either side
+FAN_OUT = 3  # Peaks after an anchor that its sub-hashes are made from
+MAX_DT = 63  # Frames between peaks of a sub-hash, fits 6 bits
+BLOCK_FRAMES = 4096  # Spectrogram frames computed at a time, bounds memory for long tracks
+
+MIN_MATCHES = 20  # Sub-hashes that must agree on an offset
+MIN_SCORE = 0.03  # and the share of the shorter file's sub-hashes they must be
+DURATION_TOLERANCE = 0.05  # Durations may differ by this share
+DURATION_SLACK_SECONDS = 10  # or by this much, for trimmed silence
+MAX_POSTINGS = 64  # Sub-hashes in more files than this match too much to be told apart
+
+_WINDOW = np.hanning(FFT_SIZE).astype(np.float32)
+
+
+class Fingerprint:
+    def __init__(self, hashes, times, frames):
+        self.hashes = hashes  # uint64 sub-hashes, each once, at its first time
+        self.times = times  # uint32 anchor frame of each
+        self.frames = frames  # Length of the audio in frames
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @property
+    def seconds(self):
+        return self.frames * HOP / SAMPLE_RATE
+
+    def encode(self):
+        """Text form for the hash cache."""
+        return (str(self.frames) + ':' + base64.b64encode(self.hashes.astype('<u8').tobytes()).decode('ascii')
+                + ':' + base64.b64encode(self.times.astype('<u4').tobytes()).decode('ascii'))
+
+    @classmethod
+    def decode(cls, text):
+        frames, hashes, times = text.split(':')
+        return cls(np.frombuffer(base64.b64decode(hashes), dtype='<u8').astype(np.uint64),
+                   np.frombuffer(base64.b64decode(times), dtype='<u4').astype(np.uint32), int(frames))
+
+
+def _spectrogram(samples, first, last):
+    # Log magnitude of frames first..last-1, frames x bins, Nyquist bin left out
+    frames = sliding_window_view(samples[first * HOP:(last - 1) * HOP + FFT_SIZE], FFT_SIZE)[::HOP]
+    spectrum = np.abs(np.fft.rfft(frames * _WINDOW, axis=1))[:, :FFT_SIZE // 2]
+    return np.log1p(spectrum, dtype=np.float32)
+
+
+def _max_filter(values, size, axis):
+    padded = np.pad(values, [(size, size) if a == axis else (0, 0) for a in range(values.ndim)], mode='edge')
+    return sliding_window_view(padded, 2 * size + 1, axis=axis).max(axis=-1)
+
+
+def peaks(samples):
+    """(frames, bins) of the spectral peaks of mono float32 samples at SAMPLE_RATE."""
+    frame_count = max(0, 1 + (len(samples) - FFT_SIZE) // HOP)
+    times, bins = [], []
+    for start in range(0, frame_count, BLOCK_FRAMES):
+        # Each block with PEAK_TIME frames of context, so peaks at its edges are the same
+        first = max(start - PEAK_TIME, 0)
+        last = min(start + BLOCK_FRAMES + PEAK_TIME, frame_count)
+        spectrum = _spectrogram(samples, first, last)
+        local_max = _max_filter(_max_filter(spectrum, PEAK_FREQ, 1), PEAK_TIME, 0)
+        # Above the block's mean, so silence and flat noise give none
+        is_peak = (spectrum == local_max) & (spectrum > spectrum.mean())
+        frame, freq = np.nonzero(is_peak)
+        frame += first
+        keep = (frame >= start) & (frame < start + BLOCK_FRAMES)
+        times.append(frame[keep])
+        bins.append(freq[keep])
+    if not times:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    return np.concatenate(times), np.concatenate(bins)
+
+
+def fingerprint(samples):
+    """Fingerprint of mono samples at SAMPLE_RATE, int16 or float."""
+    samples = np.asarray(samples)
+    frame_count = max(0, 1 + (len(samples) - FFT_SIZE) // HOP)
+    times, bins = peaks(samples)  # In time order
+    times, bins = times.astype(np.int64), bins.astype(np.int64)
+    hashes, anchors = [], []
+    for a in range(1, FAN_OUT + 1):
+        for b in range(a + 1, FAN_OUT + 1):
+            if len(times) <= b:
+                continue
+            t1, t2, t3 = times[:-b], times[a:len(times) - b + a], times[b:]
+            dt1, dt2 = t2 - t1, t3 - t2
+            ok = t3 - t1 <= MAX_DT
+            f1, f2, f3 = bins[:-b][ok], bins[a:len(bins) - b + a][ok], bins[b:][ok]
+            hashes.append((f1 << 32) | (f2 << 22) | (f3 << 12) | (dt1[ok] << 6) | dt2[ok])
+            anchors.append(t1[ok])
+    if not hashes:
+        return Fingerprint(np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint32), frame_count)
+    hashes, anchors = np.concatenate(hashes), np.concatenate(anchors)
+    # Repeating music has the same sub-hash many times; its first time is enough
+    order = np.lexsort((anchors, hashes))
+    hashes, anchors = hashes[order], anchors[order]
+    first = np.concatenate(([True], hashes[1:] != hashes[:-1]))
+    return Fingerprint(hashes[first].astype(np.uint64), anchors[first].astype(np.uint32), frame_count)
+
+
+class Resampler:
+    """
+    Mono int16 samples at SAMPLE_RATE from interleaved PCM fed in chunks of any size,
+    so a track can be fingerprinted as it streams by.  Channels are averaged and the
+    rate changed by linear interpolation.
+    """
+    DTYPES = {1: np.int8, 2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+    def __init__(self, sample_width, frame_rate, channels):
+        self.dtype = self.DTYPES[sample_width]
+        self.scale = 2.0 ** (16 - 8 * sample_width)  # To the int16 range
+        self.frame_bytes = sample_width * channels
+        self.channels = channels
+        self.step = frame_rate / SAMPLE_RATE  # Input frames per output sample
+        self.rest = b''  # Bytes of a partial frame
+        self.tail = np.empty(0, dtype=np.float32)  # Input frames still needed, from frame self.first
+        self.first = 0
+        self.produced = 0
+        self.out = []
+
+    def add(self, chunk):
+        chunk = self.rest + chunk
+        usable = len(chunk) - len(chunk) % self.frame_bytes
+        self.rest = chunk[usable:]
+        mono = np.frombuffer(chunk[:usable], dtype=self.dtype).reshape(-1, self.channels).mean(axis=1)
+        frames = np.concatenate((self.tail, (mono * self.scale).astype(np.float32)))
+        # Output samples whose position has an input frame after it to interpolate to
+        last = self.first + len(frames) - 1
+        count = max(0, int((last - self.produced * self.step) // self.step) + 1)
+        positions = (self.produced + np.arange(count)) * self.step - self.first
+        samples = np.interp(positions, np.arange(len(frames)), frames)
+        self.out.append(np.clip(np.round(samples), -32768, 32767).astype(np.int16))
+        self.produced += count
+        keep = min(int(self.produced * self.step) - self.first, len(frames))
+        self.tail = frames[keep:]
+        self.first += keep
+
+    def samples(self):
+        return np.concatenate(self.out) if self.out else np.empty(0, dtype=np.int16)
+
+
+class FingerprintIndex:
+    def __init__(self):
+        self.paths = []
+        self.fingerprints = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path, fp):
+        self.paths.append(path)
+        self.fingerprints.append(fp)
+
+    def matches(self, min_matches=MIN_MATCHES, min_score=MIN_SCORE, max_postings=MAX_POSTINGS):
+        """
+        (path, other path, score) for every pair of files that are the same recording.
+        score is the share of the shorter file's sub-hashes matching at the best offset.
+        """
+        if len(self.paths) < 2:
+            return []
+        lengths = np.array([len(fp) for fp in self.fingerprints], dtype=np.int64)
+        hashes = np.concatenate([fp.hashes for fp in self.fingerprints])
+        times = np.concatenate([fp.times for fp in self.fingerprints]).astype(np.int64)
+        files = np.repeat(np.arange(len(self.paths)), lengths)
+        order = np.argsort(hashes, kind='stable')
+        hashes, times, files = hashes[order], times[order], files[order]
+
+        # Postings of a sub-hash are adjacent; pair each with the ones after it
+        starts = np.concatenate(([0], np.flatnonzero(hashes[1:] != hashes[:-1]) + 1))
+        sizes = np.diff(np.concatenate((starts, [len(hashes)])))
+        usable = np.repeat(sizes <= max_postings, sizes)
+        pair_keys, offsets = [], []
+        for shift in range(1, max_postings):
+            same = (hashes[shift:] == hashes[:-shift]) & usable[shift:]
+            if not same.any():
+                break
+            a, b = np.flatnonzero(same), np.flatnonzero(same) + shift
+            file_a, file_b = files[a], files[b]
+            # Files are sorted within a posting list by the stable sort, so file_a <= file_b
+            other = file_a != file_b
+            pair_keys.append(file_a[other] * len(self.paths) + file_b[other])
+            offsets.append(times[b][other] - times[a][other])
+        if not pair_keys:
+            return []
+        pair_keys, offsets = np.concatenate(pair_keys), np.concatenate(offsets)
+
+        # Votes per (pair, offset), plus the offsets either side for frame jitter
+        votes, counts = np.unique(np.stack((pair_keys, offsets)), axis=1, return_counts=True)
+        pair_keys, offsets = votes
+        smoothed = counts.copy()
+        for step in (1, -1):
+            neighbour = np.roll(np.arange(len(counts)), -step)
+            next_to = (pair_keys[neighbour] == pair_keys) & (offsets[neighbour] == offsets + step)
+            smoothed += np.where(next_to, counts[neighbour], 0)
+        pair_starts = np.concatenate(([0], np.flatnonzero(pair_keys[1:] != pair_keys[:-1]) + 1))
+        best = np.maximum.reduceat(smoothed, pair_starts)
+
+        found = []
+        for key, matched in zip(pair_keys[pair_starts].tolist(), best.tolist()):
+            a, b = divmod(key, len(self.paths))
+            fp_a, fp_b = self.fingerprints[a], self.fingerprints[b]
+            score = matched / max(min(len(fp_a), len(fp_b)), 1)
+            slack = max(DURATION_TOLERANCE * max(fp_a.seconds, fp_b.seconds), DURATION_SLACK_SECONDS)
+            if matched >= min_matches and score >= min_score and abs(fp_a.seconds - fp_b.seconds) <= slack:
+                found.append((self.paths[a], self.paths[b], score))
+        return found
+
+    def duplicates(self, **kwargs):
+        """Groups of paths joined by matches(), largest first."""
+        parent = {}
+
+        def find(path):
+            while parent.setdefault(path, path) != path:
+                parent[path] = parent[parent[path]]
+                path = parent[path]
+            return path
+
+        for path_a, path_b, score in self.matches(**kwargs):
+            root_a, root_b = find(path_a), find(path_b)
+            if root_a != root_b:
+                parent[root_b] = root_a
+        groups = {}
+        for path in self.paths:
+            if path in parent:
+                groups.setdefault(find(path), []).append(path)
+        return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from pydub import AudioSegment
+
+from audioanalysis import analyse_audio
+
+# Per file cost of find_duplicate_audio_files.py's analysis of a new file: the old
+# createhash + get_audio_data, each decoding the whole track, against analyse_audio
+# streaming it once and reading tags from the container.  Uses WAV, plus FLAC and MP3
+# when ffmpeg is installed, and checks both give the same PCM hash.  Peak memory is
+# Python's allocations while analysing one track, which for the old analysis grows
+# with the track's length and for the streamed one stays at a few chunks.
+#
+# usage: python benchmarks/bench_audio_analysis.py [seconds per track] [tracks]
+
+REPEAT = 3
+
+
+def make_tracks(directory, seconds, count):
+    rng = np.random.default_rng(0)
+    formats = ['wav'] + (['flac', 'mp3'] if shutil.which('ffmpeg') else [])
+    tracks = {}
+    for fmt in formats:
+        tracks[fmt] = []
+        for n in range(count):
+            samples = (rng.normal(0, 3000, int(seconds * 44100) * 2)).astype(np.int16)
+            audio = AudioSegment(samples.tobytes(), frame_rate=44100, sample_width=2, channels=2)
+            path = os.path.join(directory, f"track{n}.{fmt}")
+            audio.export(path, format=fmt, tags={'title': f"track {n}", 'artist': 'bench'})
+            tracks[fmt].append(path)
+    return tracks
+
+
+def old_analysis(path):
+    # createhash, then get_audio_data's own decode
+    audio = AudioSegment.from_file(path)
+    file_hash = hashlib.blake2b(audio.raw_data, digest_size=16).hexdigest()
+    audio_file = AudioSegment.from_file(path)
+    audio_file.frame_count()
+    return file_hash
+
+
+def new_analysis(path):
+    return analyse_audio(path)[0]
+
+
+def timed(func, paths):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for path in paths:
+            func(path)
+        elapsed = (time.perf_counter() - start) / len(paths)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(func, path):
+    tracemalloc.start()
+    try:
+        func(path)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    directory = tempfile.mkdtemp(prefix='bench_audio')
+    try:
+        tracks = make_tracks(directory, seconds, count)
+        print(f"{seconds:.0f} s stereo tracks, {count} per format")
+        print(f"{'format':>6} {'old ms/file':>12} {'new ms/file':>12} {'speedup':>8} {'old peak MB':>12} "
+              f"{'new peak MB':>12}")
+        for fmt, paths in tracks.items():
+            assert all(old_analysis(path) == new_analysis(path) for path in paths)
+            old_time = timed(old_analysis, paths)
+            new_time = timed(new_analysis, paths)
+            old_peak = peak_memory(old_analysis, paths[0]) / 2 ** 20
+            new_peak = peak_memory(new_analysis, paths[0]) / 2 ** 20
+            print(f"{fmt:>6} {old_time * 1000:>12.1f} {new_time * 1000:>12.1f} {old_time / new_time:>7.1f}x "
+                  f"{old_peak:>12.1f} {new_peak:>12.1f}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
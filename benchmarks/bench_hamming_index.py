@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from perceptualhash import HammingIndex, popcount
+
+# Compares finding every pair of 64 bit hashes within MAX_DISTANCE bits by brute
+# force against HammingIndex.  Hashes are random with a share of near copies, a few
+# bits flipped from an earlier hash.  Brute force is quadratic, so it is timed over a
+# sample of hashes against all of them and extrapolated; at the smallest size the
+# two pair sets are also checked to be equal.
+#
+# usage: python benchmarks/bench_hamming_index.py [sizes...]
+
+MAX_DISTANCE = 6
+NEAR_RATE = 0.02  # Fraction of hashes that are near copies of another
+MAX_FLIPS = 8  # Bits flipped in a near copy, some land beyond MAX_DISTANCE
+BRUTE_SAMPLE = 200
+
+
+def make_hashes(n):
+    rng = np.random.default_rng(n)
+    hashes = rng.integers(0, 2 ** 63, n, dtype=np.uint64) << np.uint64(1) | rng.integers(0, 2, n, dtype=np.uint64)
+    copies = int(n * NEAR_RATE)
+    for source, target, flips in zip(rng.integers(0, n, copies), rng.integers(0, n, copies),
+                                     rng.integers(0, MAX_FLIPS + 1, copies)):
+        value = int(hashes[source])
+        for bit in rng.choice(64, flips, replace=False):
+            value ^= 1 << int(bit)
+        hashes[target] = value
+    return hashes
+
+
+def brute_force(hashes, rows):
+    pairs = set()
+    for i in rows:
+        distance = popcount(hashes ^ hashes[i])
+        pairs.update((i, j) for j in np.flatnonzero(distance <= MAX_DISTANCE).tolist() if i < j)
+    return pairs
+
+
+def bench(n, check):
+    hashes = make_hashes(n)
+
+    start = time.perf_counter()
+    i, j, _ = HammingIndex(hashes).pairs(MAX_DISTANCE)
+    index_total = time.perf_counter() - start
+
+    if check:
+        start = time.perf_counter()
+        assert brute_force(hashes, range(n)) == set(zip(i.tolist(), j.tolist()))
+        brute_total = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        brute_force(hashes, range(BRUTE_SAMPLE))
+        brute_total = (time.perf_counter() - start) / BRUTE_SAMPLE * n
+
+    print(f"{n:>9} hashes  {len(i):>7} pairs  brute force {brute_total:>9.1f}s{'' if check else ' (est)'}  "
+          f"HammingIndex {index_total:>6.2f}s  {brute_total / index_total:>7.0f}x")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [20_000, 100_000, 1_000_000]
+    for number, n in enumerate(sizes):
+        bench(n, check=number == 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hashcore
+
+# Compares hashcore strategies and buffer sizes on many small files and one large file.
+# 'read' is the old allocate-a-new-bytes-per-chunk loop.  Files are hashed once to warm
+# the page cache and the cache is kept (drop_cache=False), so the numbers show the
+# per-chunk overhead rather than the disk.
+#
+# usage: python benchmarks/bench_hashcore.py [large file MB] [small file count]
+
+MB = 1024 * 1024
+BUFFER_SIZES = [64 * 1024, 1 * MB, 4 * MB, 16 * MB, 64 * MB]
+STRATEGIES = ['read', 'readinto', 'mmap']
+SMALL_FILE_SIZE = 16 * 1024
+REPEAT = 3
+
+
+def make_files(directory, large_mb, small_count):
+    large = os.path.join(directory, 'large.bin')
+    with open(large, 'wb') as f:
+        block = os.urandom(MB)
+        for _ in range(large_mb):
+            f.write(block)
+    small = []
+    for i in range(small_count):
+        path = os.path.join(directory, 'small%05d.bin' % i)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(SMALL_FILE_SIZE))
+        small.append(path)
+    return large, small
+
+
+def timed(paths, strategy, buffer_size):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for path in paths:
+            hashcore.hash_file(path, strategy=strategy, buffer_size=buffer_size, drop_cache=False)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    large_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    small_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    directory = tempfile.mkdtemp(prefix='bench_hashcore')
+    try:
+        large, small = make_files(directory, large_mb, small_count)
+        timed([large], 'read', MB)
+        timed(small, 'read', MB)
+
+        print(f"{'strategy':>9} {'buffer':>8} {'large MB/s':>11} {'small files/s':>14}")
+        for strategy in STRATEGIES:
+            for buffer_size in BUFFER_SIZES:
+                large_time = timed([large], strategy, buffer_size)
+                small_time = timed(small, strategy, buffer_size)
+                print(f"{strategy:>9} {buffer_size // 1024:>6}KB {large_mb / large_time:>11.1f} "
+                      f"{len(small) / small_time:>14.1f}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
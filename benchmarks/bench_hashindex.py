@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashindex import HashIndex
+
+# Compares duplicate detection with the old linear scans over filehashes against
+# HashIndex, at 100k and 1M files.  The old loop is quadratic, so it is timed over a
+# sample of lookups against a full size dict and extrapolated to the whole run.
+
+SIZES = [100_000, 1_000_000]
+DUPLICATE_RATE = 0.05  # Fraction of files that repeat an earlier hash
+OLD_SAMPLE = 50  # Lookups timed for the old approach
+
+
+def make_files(n):
+    random.seed(n)
+    hashes = []
+    for i in range(n):
+        if hashes and random.random() < DUPLICATE_RATE:
+            hashes.append(random.choice(hashes))
+        else:
+            hashes.append('%0128x' % random.getrandbits(512))
+    return [('/data/file%08d' % i, h) for i, h in enumerate(hashes)]
+
+
+def old_lookup(filehashes, file_hash):
+    if file_hash in filehashes.values():
+        return [k for k, v in filehashes.items() if v == file_hash]
+    return []
+
+
+def bench(n):
+    files = make_files(n)
+
+    start = time.perf_counter()
+    index = HashIndex()
+    for filepath, file_hash in files:
+        index.add(filepath, file_hash)
+    index_total = time.perf_counter() - start
+
+    # Time the old check against a dict that already holds every other file
+    filehashes = dict(files[:-OLD_SAMPLE])
+    sample = random.sample(files, OLD_SAMPLE)
+    start = time.perf_counter()
+    for filepath, file_hash in sample:
+        old_lookup(filehashes, file_hash)
+    old_per_file = (time.perf_counter() - start) / OLD_SAMPLE
+    # On average the dict is half full during a run
+    old_total = old_per_file * n / 2
+
+    print(f"{n:>9} files  index: {index_total:8.2f} s  "
+          f"old scan: {old_per_file * 1000:8.2f} ms/file, ~{old_total / 3600:8.2f} h total  "
+          f"({len(index.duplicates())} duplicate hashes)")
+
+
+if __name__ == "__main__":
+    for n in SIZES:
+        bench(n)
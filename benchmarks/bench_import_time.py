@@ -0,0 +1,55 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import statistics
+
+# Times `import combo` in a fresh interpreter and checks that none of the heavy
+# dependencies came in with it.  Exits non-zero if one did, or if the median import
+# time is over the limit, so it can guard against a top level import creeping back.
+#
+# usage: python benchmarks/bench_import_time.py [runs] [limit seconds]
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['numpy', 'pandas', 'cv2', 'onnxruntime', 'huggingface_hub', 'tqdm', 'PIL.Image']
+
+CHILD = '''
+import sys, time, json
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+import combo
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def run_once():
+    code = CHILD.format(repo=REPO, heavy=HEAVY_MODULES)
+    # Run somewhere else so nothing lands in the repo if a log file does get opened
+    with tempfile.TemporaryDirectory() as cwd:
+        output = subprocess.run([sys.executable, '-c', code], cwd=cwd, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    limit = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    results = [run_once() for _ in range(runs)]
+    seconds = [result['seconds'] for result in results]
+    loaded = results[0]['loaded']
+
+    print(f"import combo: median {statistics.median(seconds) * 1000:.1f} ms, "
+          f"min {min(seconds) * 1000:.1f} ms over {runs} runs")
+    failed = False
+    if loaded:
+        print("FAIL: imported at startup: " + ", ".join(loaded))
+        failed = True
+    if statistics.median(seconds) > limit:
+        print(f"FAIL: over the {limit * 1000:.0f} ms limit")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from combo import TagTable, WaifuDiffusionInterrogator, wd14_tags_to_text
+
+# Compares WD14 post-processing: the old per image DataFrame + dicts + re.sub path
+# against TagTable on the confidence array, per batch size.  Uses a synthetic tag
+# table the size of the vit tagger's (4 ratings, ~9k tags) and confidences skewed so
+# a few dozen tags per image pass the threshold, like real output.  Both paths are
+# checked to give the same results.
+#
+# usage: python benchmarks/bench_wd14_postprocess.py [images per batch size]
+
+NUM_TAGS = 9083
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+REPEAT = 3
+
+
+def make_tags():
+    rng = np.random.default_rng(0)
+    names = ['general', 'sensitive', 'questionable', 'explicit']
+    names += ['tag_%d_(x)' % i if i % 50 == 0 else 'tag_%d' % i for i in range(NUM_TAGS - 4)]
+    categories = [9] * 4 + rng.choice([0, 4], NUM_TAGS - 4).tolist()
+    return pd.DataFrame({'name': names, 'category': categories})
+
+
+def old_postprocess(tags, confidences):
+    results = []
+    for confidence in confidences:
+        full_tags = tags[['name', 'category']].copy()
+        full_tags['confidence'] = confidence
+        results.append(wd14_tags_to_text(*WaifuDiffusionInterrogator._split_ratings(full_tags)))
+    return results
+
+
+def timed(func, batches):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for batch in batches:
+            func(batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    images = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    tags = make_tags()
+    table = TagTable(tags)
+    rng = np.random.default_rng(1)
+    confidences = rng.beta(0.05, 2.0, size=(images, NUM_TAGS)).astype(np.float32)
+
+    old = old_postprocess(tags, confidences[:4])
+    new = table.to_text_batch(confidences[:4])
+    for (old_ratings, old_text, old_tags), (new_ratings, new_text, new_tags) in zip(old, new):
+        assert old_text == new_text and old_tags.keys() == new_tags.keys() and old_ratings.keys() == new_ratings.keys()
+
+    print(f"{'batch':>6} {'old images/s':>13} {'new images/s':>13} {'speedup':>8}")
+    for batch_size in BATCH_SIZES:
+        batches = [confidences[i:i + batch_size] for i in range(0, images, batch_size)]
+        old_time = timed(lambda batch: old_postprocess(tags, batch), batches)
+        new_time = timed(table.to_text_batch, batches)
+        print(f"{batch_size:>6} {images / old_time:>13.1f} {images / new_time:>13.1f} {old_time / new_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
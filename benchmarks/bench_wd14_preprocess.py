@@ -0,0 +1,98 @@
+import os
+import io
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+from combo import image_draft, image_make_square, image_smart_resize, image_to_model_input
+
+# Compares WD14 preprocessing: the old full resolution RGBA composite + pad + resize
+# + np.stack path against image_draft + image_to_model_input writing into a reused
+# float32 batch.  Times decode and preprocessing together, from encoded bytes, for a
+# large JPEG photo, a large opaque PNG and a PNG with alpha.
+#
+# usage: python benchmarks/bench_wd14_preprocess.py [megapixels] [batch size]
+
+SIZE = 448
+REPEAT = 3
+
+
+def make_images(megapixels):
+    width = int((megapixels * 1e6 * 1.5) ** 0.5)
+    height = int(width / 1.5)
+    rng = np.random.default_rng(0)
+    # Smooth gradients plus noise, so the JPEG compresses like a photo rather than noise
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    rgb = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                    (x + y) / 2], axis=-1)
+    rgb = np.clip(rgb + rng.normal(0, 8, rgb.shape), 0, 255).astype(np.uint8)
+    images = {}
+    for name, image, fmt in (('jpeg', Image.fromarray(rgb), 'JPEG'),
+                             ('png', Image.fromarray(rgb), 'PNG'),
+                             ('png alpha', Image.fromarray(rgb).convert('RGBA'), 'PNG')):
+        buffer = io.BytesIO()
+        if fmt == 'JPEG':
+            image.save(buffer, fmt, quality=90)
+        else:
+            image.save(buffer, fmt, compress_level=1)
+        images[name] = buffer.getvalue()
+    return images
+
+
+def old_preprocess(data):
+    image = Image.open(io.BytesIO(data)).convert('RGBA')
+    new_image = Image.new('RGBA', image.size, 'WHITE')
+    new_image.paste(image, mask=image)
+    image = np.asarray(new_image.convert('RGB'))[:, :, ::-1]
+    image = image_make_square(image, SIZE)
+    image = image_smart_resize(image, SIZE)
+    return image.astype(np.float32)
+
+
+def old_batch(items):
+    return np.stack([old_preprocess(data) for data in items])
+
+
+def new_batch(items, buffer):
+    batch = buffer[:len(items)]
+    for slot, data in zip(batch, items):
+        image = image_draft(Image.open(io.BytesIO(data)), SIZE)
+        image_to_model_input(image, SIZE, out=slot)
+    return batch
+
+
+def timed(func, items):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(items)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    megapixels = float(sys.argv[1]) if len(sys.argv) > 1 else 24
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    images = make_images(megapixels)
+    buffer = np.empty((batch_size, SIZE, SIZE, 3), dtype=np.float32)
+
+    print(f"{megapixels:.0f} MP, batches of {batch_size}")
+    print(f"{'image':>10} {'old images/s':>13} {'new images/s':>13} {'speedup':>8} {'mean diff':>9}")
+    for name, data in images.items():
+        items = [data] * batch_size
+        old_time = timed(old_batch, items)
+        new_time = timed(lambda items: new_batch(items, buffer), items)
+        # The draft decode and resizing before padding change pixels slightly, not the picture
+        diff = np.abs(old_batch(items[:1])[0] - new_batch(items[:1], buffer)[0]).mean()
+        print(f"{name:>10} {batch_size / old_time:>13.2f} {batch_size / new_time:>13.2f} "
+              f"{old_time / new_time:>7.1f}x {diff:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,79 @@
+from __future__ import annotations
 import os
 import sys
+import time
+# Taken before the imports below so startup timings include them
+STARTED = time.perf_counter()
 import re
-from typing import Mapping, Tuple, Dict
-import pandas as pd
-import cv2
-import numpy as np
-from PIL import Image
-from huggingface_hub import hf_hub_download
-from onnxruntime import InferenceSession
+from typing import Mapping, Tuple, Dict, List
+from lazyimport import lazy_module
 import concurrent.futures
+import threading
+import queue
 import subprocess
 from datetime import datetime
 import logging
 from logging.handlers import RotatingFileHandler
-from tqdm import tqdm
 import exiftool
 from exiftool.exceptions import ExifToolExecuteError
-import hashlib
+from exiftool_pool import pool as et_pool
+import itertools
+import csv
+import tempfile
+import scanner
+import processingstate
+from imagetypes import IMAGE_EXTENSIONS
 
 
 import shutil
 from collections import Counter
+from collections.abc import Mapping as MappingABC
+
+# The heavy dependencies are imported the first time they're used, so modes that
+# never load the model (adding given tags, person tags, hashing) don't pay for
+# them at startup.  See benchmarks/bench_import_time.py.
+pd = lazy_module('pandas')
+cv2 = lazy_module('cv2')
+np = lazy_module('numpy')
+Image = lazy_module('PIL.Image')
+pixelhash = lazy_module('pixelhash')
 
 #pip install opencv-python pillow huggingface_hub onnxruntime pyexiftool
 #from timer import Timer
 
 # Needs exiftool too
 
-#IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp')
-#bmp does not support many tags
-IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff',)
 TEXT_EXTENSIONS = ('.txt',)
 
+# WD14 inference is batched across images.  A batch is run when it has
+# WD14_BATCH_SIZE images or its oldest image has waited WD14_BATCH_TIMEOUT seconds.
+WD14_BATCH_SIZE = 8
+WD14_BATCH_TIMEOUT = 0.5
+
+# Normal tagging mode runs as a pipeline (see ImagePipeline).  Threads decoding and
+# preprocessing images, threads writing metadata with exiftool, and the size of the
+# queues between stages.  There is always a single inference stage.
+DECODE_WORKERS = os.cpu_count() or 4
+WRITE_WORKERS = 4
+PIPELINE_QUEUE_SIZE = 64
+
+# Threads for the other modes (tags, person tags), see run_tasks
+TASK_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# Processes computing pixel hashes in hash mode, see hash_files
+HASH_WORKERS = os.cpu_count() or 1
+
+# Batched metadata writes (see ExifBatchWriter).  Files per exiftool command, and how
+# many processed images a pipeline write thread collects before marking them tagged.
+EXIFTOOL_BATCH_SIZE = 200
+MARK_BATCH_SIZE = 32
+
+# WD14 results are cached by pixel hash (see inferencecache.py).  None turns it off.
+INFERENCE_CACHE_DB = 'wd14_cache.db'
+
+# What's been done to each file (see processingstate.py), so re-runs skip finished
+# files without calling exiftool.  None turns it off.
+PROCESSING_STATE_DB = 'combo_state.db'
+
 class TruncatedFileHandler(logging.FileHandler):
     def __init__(self, filename, mode='a', encoding=None, delay=False):
         super().__init__(filename, mode, encoding, delay)
@@ -66,7 +108,8 @@ def setup_logger(log_file_path, log_level=logging.INFO):
     logger.setLevel(logging.DEBUG)
     
 
-    # Create file handlers for different levels
+    # Create file handlers for different levels.  delay=True leaves each file unopened
+    # until something is logged at its level
     log_file_base = os.path.splitext(log_file_path)[0]
     
     #file_handler = TruncatedFileHandler(log_file_path)
@@ -76,10 +119,10 @@ def setup_logger(log_file_path, log_level=logging.INFO):
     #error_handler = TruncatedFileHandler(log_file_base + '_error.log')
     logfilebase = 'combo15'
     
-    debug_handler = RotatingFileHandler(log_file_base + '_debug.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=0)
-    info_handler = RotatingFileHandler(log_file_base + '_info.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=0)
-    warning_handler = RotatingFileHandler(log_file_base + '_warning.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=0)
-    error_handler = RotatingFileHandler(log_file_base + '_error.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=0)
+    debug_handler = RotatingFileHandler(log_file_base + '_debug.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=True)
+    info_handler = RotatingFileHandler(log_file_base + '_info.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=True)
+    warning_handler = RotatingFileHandler(log_file_base + '_warning.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=True)
+    error_handler = RotatingFileHandler(log_file_base + '_error.log', mode='a', maxBytes=5*1024*1024, backupCount=4, encoding=None, delay=True)
         
     # Set log levels
     #file_handler.setLevel(logging.DEBUG)
@@ -145,6 +188,90 @@ def image_smart_resize(img, size):
 
     return img
 
+_inference_cache = None
+_inference_cache_lock = threading.Lock()
+
+def get_inference_cache():
+    # The shared InferenceCache, opened on first use.  None if INFERENCE_CACHE_DB is None
+    global _inference_cache
+    if INFERENCE_CACHE_DB is None:
+        return None
+    with _inference_cache_lock:
+        if _inference_cache is None:
+            from inferencecache import InferenceCache
+            _inference_cache = InferenceCache(INFERENCE_CACHE_DB)
+        return _inference_cache
+
+def close_inference_cache():
+    global _inference_cache
+    with _inference_cache_lock:
+        if _inference_cache is not None:
+            logger.info(_inference_cache.summary())
+            _inference_cache.close()
+            _inference_cache = None
+
+_processing_state = None
+_processing_state_lock = threading.Lock()
+
+def get_processing_state():
+    # The shared ProcessingState, opened on first use.  None if PROCESSING_STATE_DB is None
+    global _processing_state
+    if PROCESSING_STATE_DB is None:
+        return None
+    with _processing_state_lock:
+        if _processing_state is None:
+            _processing_state = processingstate.ProcessingState(PROCESSING_STATE_DB)
+        return _processing_state
+
+def close_processing_state():
+    global _processing_state
+    with _processing_state_lock:
+        if _processing_state is not None:
+            _processing_state.close()
+            _processing_state = None
+
+def record_outcome(path, outcome):
+    # Note in the processing state that outcome (a processingstate flag) is done for path
+    state = get_processing_state()
+    if state is not None:
+        state.mark(path, outcome)
+
+def image_draft(image, size):
+    # Ask the JPEG decoder for a reduced scale (1/2, 1/4 or 1/8) that still leaves both
+    # sides at least size.  Must come before the pixels are loaded; other formats ignore it.
+    image.draft('RGB', (size, size))
+    return image
+
+def image_to_model_input(image, size, out=None):
+    """
+    WD14 input for a PIL image: white background, padded to square, size x size, BGR.
+    Alpha is only composited when the image has some, and the image is shrunk before
+    padding so only size x size pixels are padded.  Returns a uint8 array, or fills
+    out (e.g. a float32 slot of a batch) and returns it.
+    """
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        rgba = image.convert('RGBA')
+        image = Image.new('RGBA', rgba.size, 'WHITE')
+        image.alpha_composite(rgba)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    pixels = np.asarray(image)
+
+    height, width = pixels.shape[:2]
+    longest = max(height, width)
+    if longest > size:
+        width = max(1, round(width * size / longest))
+        height = max(1, round(height * size / longest))
+        pixels = cv2.resize(pixels, (width, height), interpolation=cv2.INTER_AREA)
+
+    if out is None:
+        out = np.empty((size, size, 3), dtype=np.uint8)
+    out.fill(255)
+    top, left = (size - height) // 2, (size - width) // 2
+    # PIL RGB to OpenCV BGR, converting to out's dtype on the way
+    out[top:top + height, left:left + width] = pixels[:, :, ::-1]
+    return out
+
 class WaifuDiffusionInterrogator:
     def __init__(
             self,
@@ -159,53 +286,89 @@ class WaifuDiffusionInterrogator:
         self._provider_mode = mode
 
         self.__initialized = False
+        self.__init_lock = threading.Lock()
         self._model, self._tags = None, None
+        self._buffers = threading.local()
+        self._first_run = True
+
+    @property
+    def source(self) -> str:
+        # Where the model comes from, part of the inference cache key
+        return self.__repo + '/' + self.__model_path
 
     def _init(self) -> None:
         if self.__initialized:
             return
 
-        model_path = hf_hub_download(self.__repo, filename=self.__model_path)
-        tags_path = hf_hub_download(self.__repo, filename=self.__tags_path)
+        # Pipeline decode threads can all arrive here at once on the first images
+        with self.__init_lock:
+            if not self.__initialized:
+                self._load()
+
+    def _load(self) -> None:
+        # onnxruntime and huggingface_hub come in with the first model
+        import modelregistry
 
-        self._model = InferenceSession(str(model_path))
+        start = time.perf_counter()
+        model_path = modelregistry.resolve(self.__repo, self.__model_path)
+        tags_path = modelregistry.resolve(self.__repo, self.__tags_path)
+
+        # One session for the process; run() is safe to call from any thread
+        self._model = modelregistry.create_session(self.__repo, model_path, self._provider_mode)
         self._tags = pd.read_csv(tags_path)
+        self._tag_table = TagTable(self._tags)
+        _, self.input_size, _, _ = self._model.get_inputs()[0].shape
+        self.load_seconds = time.perf_counter() - start
 
         self.__initialized = True
 
-    def _calculation(self, image: Image.Image)  -> pd.DataFrame:
+    def draft(self, image: Image.Image) -> Image.Image:
+        # Call on a freshly opened image, before anything reads its pixels
         self._init()
 
-        _, height, _, _ = self._model.get_inputs()[0].shape
+        return image_draft(image, self.input_size)
 
-        # alpha to white
-        image = image.convert('RGBA')
-        new_image = Image.new('RGBA', image.size, 'WHITE')
-        new_image.paste(image, mask=image)
-        image = new_image.convert('RGB')
-        image = np.asarray(image)
+    def preprocess(self, image: Image.Image) -> np.ndarray:
+        # uint8 model input, a quarter the size of the float32 batch slot it ends up in
+        self._init()
+
+        return image_to_model_input(image, self.input_size)
 
-        # PIL RGB to OpenCV BGR
-        image = image[:, :, ::-1]
+    def _batch_buffer(self, size: int) -> np.ndarray:
+        # Reused float32 input batch, one per thread as onnxruntime reads it during run()
+        buffer = getattr(self._buffers, 'batch', None)
+        if buffer is None or len(buffer) < size:
+            buffer = self._buffers.batch = np.empty((max(size, WD14_BATCH_SIZE), self.input_size, self.input_size, 3),
+                                                    dtype=np.float32)
+        return buffer[:size]
 
-        image = image_make_square(image, height)
-        image = image_smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+    def _run(self, batch: np.ndarray) -> np.ndarray:
+        self._init()
 
-        # evaluate model
+        # evaluate model on a (batch, height, width, 3) array
         input_name = self._model.get_inputs()[0].name
         label_name = self._model.get_outputs()[0].name
-        confidence = self._model.run([label_name], {input_name: image})[0]
+        confidences = self._model.run([label_name], {input_name: batch})[0]
+
+        if self._first_run:
+            self._first_run = False
+            logger.info("WD14 " + self.source + ": first inference " + f"{time.perf_counter() - STARTED:.2f}"
+                        + " seconds after start, model load took " + f"{self.load_seconds:.2f}" + " seconds")
+        return confidences
 
+    def _full_tags(self, confidence: np.ndarray) -> pd.DataFrame:
         full_tags = self._tags[['name', 'category']].copy()
-        full_tags['confidence'] = confidence[0]
+        full_tags['confidence'] = confidence
 
         return full_tags
 
-    def interrogate(self, image: Image) -> Tuple[Dict[str, float], Dict[str, float]]:
-        full_tags = self._calculation(image)
+    def _calculation(self, image: Image.Image)  -> pd.DataFrame:
+        confidence = self.confidence_batch([image])
+
+        return self._full_tags(confidence[0])
 
+    @staticmethod
+    def _split_ratings(full_tags: pd.DataFrame) -> Tuple[Dict[str, float], Dict[str, float]]:
         # first 4 items are for rating (general, sensitive, questionable, explicit)
         ratings = dict(full_tags[full_tags['category'] == 9][['name', 'confidence']].values)
 
@@ -214,40 +377,273 @@ class WaifuDiffusionInterrogator:
 
         return ratings, tags
 
-WAIFU_MODELS: Mapping[str, WaifuDiffusionInterrogator] = {
-    'wd14-vit-v2': WaifuDiffusionInterrogator(),
-    'wd14-convnext': WaifuDiffusionInterrogator(
-        repo='SmilingWolf/wd-v1-4-convnext-tagger'
-    ),
-}
-RE_SPECIAL = re.compile(r'([\\()])')
+    def interrogate(self, image: Image) -> Tuple[Dict[str, float], Dict[str, float]]:
+        return self._split_ratings(self._calculation(image))
+
+    def tags_from_confidence(self, confidence: np.ndarray) -> Tuple[Dict[str, float], Dict[str, float]]:
+        self._init()
+
+        return self._split_ratings(self._full_tags(confidence))
+
+    def confidence_batch(self, images) -> np.ndarray:
+        # images can be PIL images or arrays already returned by preprocess().  Both are
+        # written straight into the batch buffer, so there's no per image float32 copy.
+        self._init()
+
+        batch = self._batch_buffer(len(images))
+        for slot, image in zip(batch, images):
+            if isinstance(image, np.ndarray):
+                slot[...] = image
+            else:
+                image_to_model_input(image, self.input_size, out=slot)
+
+        return self._run(batch)
+
+    def interrogate_batch(self, images) -> List[Tuple[Dict[str, float], Dict[str, float]]]:
+        return [self.tags_from_confidence(confidence) for confidence in self.confidence_batch(images)]
 
+    def postprocess(self, confidence: np.ndarray) -> Tuple[Mapping[str, float], str, Mapping[str, float]]:
+        # Same result as wd14_tags_to_text(*tags_from_confidence(confidence)), without the DataFrame and dicts
+        self._init()
+
+        return self._tag_table.to_text(confidence)
+
+    def postprocess_batch(self, confidences: np.ndarray) -> List[Tuple[Mapping[str, float], str, Mapping[str, float]]]:
+        self._init()
 
-def image_to_wd14_tags(filename, image:Image.Image) \
+        return self._tag_table.to_text_batch(confidences)
+
+class ModelRegistry(MappingABC):
+    # Model name -> WaifuDiffusionInterrogator, each created the first time it's asked for
+    def __init__(self, specs):
+        self._specs = specs
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name) -> WaifuDiffusionInterrogator:
+        with self._lock:
+            if name not in self._models:
+                self._models[name] = WaifuDiffusionInterrogator(**self._specs[name])
+            return self._models[name]
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
+WAIFU_MODELS: Mapping[str, WaifuDiffusionInterrogator] = ModelRegistry({
+    'wd14-vit-v2': {},
+    'wd14-convnext': {
+        'repo': 'SmilingWolf/wd-v1-4-convnext-tagger'
+    },
+})
+RE_SPECIAL = re.compile(r'([\\()])')
+TAG_THRESHOLD = .35
+
+
+class TagTable:
+    """
+    selected_tags.csv as NumPy arrays, built once per model.  Turning a confidence
+    vector into ratings and tag text is then a threshold, a sort of the few tags
+    that pass it, and a join of tag strings that are already escaped.
+    """
+    def __init__(self, tags: pd.DataFrame) -> None:
+        names = tags['name'].to_numpy(dtype=str)
+        # category 9 is the ratings (general, sensitive, questionable, explicit)
+        is_rating = tags['category'].to_numpy() == 9
+        self.rating_index = np.flatnonzero(is_rating)
+        self.rating_names = names[is_rating].tolist()
+        self.tag_index = np.flatnonzero(~is_rating)
+        self.tag_names = names[~is_rating]
+        self.tag_text = np.array([re.sub(RE_SPECIAL, r'\\\1', name.replace('_', ' ')) for name in self.tag_names.tolist()])
+        # Position of each tag in name order, to break ties between equal scores by name
+        self.name_rank = np.empty(len(self.tag_names), dtype=np.int64)
+        self.name_rank[np.argsort(self.tag_names, kind='stable')] = np.arange(len(self.tag_names))
+
+    def to_text(self, confidence: np.ndarray, threshold=TAG_THRESHOLD) -> Tuple[Mapping[str, float], str, Mapping[str, float]]:
+        return self.to_text_batch(confidence[np.newaxis], threshold)[0]
+
+    def to_text_batch(self, confidences: np.ndarray, threshold=TAG_THRESHOLD) -> List[Tuple[Mapping[str, float], str, Mapping[str, float]]]:
+        confidences = np.asarray(confidences)
+        ratings = confidences[:, self.rating_index].tolist()
+        general = confidences[:, self.tag_index]
+
+        # Every (image, tag) over the threshold, ordered by image, then score high to low, then name
+        rows, cols = np.nonzero(general >= threshold)
+        scores = general[rows, cols]
+        order = np.lexsort((self.name_rank[cols], -scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        bounds = np.searchsorted(rows, np.arange(1, len(confidences)))
+
+        results = []
+        for image_ratings, image_cols, image_scores in zip(ratings, np.split(cols, bounds), np.split(scores, bounds)):
+            results.append((dict(zip(self.rating_names, image_ratings)),
+                            ', '.join(self.tag_text[image_cols].tolist()),
+                            dict(zip(self.tag_names[image_cols].tolist(), image_scores.tolist()))))
+        return results
+
+
+def wd14_tags_to_text(ratings, tags) -> Tuple[Mapping[str, float], str, Mapping[str, float]]:
+    filtered_tags = {
+        tag: score for tag, score in tags.items()
+        if score >= TAG_THRESHOLD
+    }
+
+    text_items = []
+    tags_pairs = filtered_tags.items()
+    tags_pairs = sorted(tags_pairs, key=lambda x: (-x[1], x[0]))
+    for tag, score in tags_pairs:
+        tag_outformat = tag
+        tag_outformat = tag_outformat.replace('_', ' ')
+        tag_outformat = re.sub(RE_SPECIAL, r'\\\1', tag_outformat)
+        text_items.append(tag_outformat)
+    output_text = ', '.join(text_items)
+
+    return ratings, output_text, filtered_tags
+
+def image_to_wd14_tags(filename, image:Image.Image, model_name='wd14-vit-v2', pixel_hash=None) \
         -> Tuple[Mapping[str, float], str, Mapping[str, float]]:
+    # pixel_hash is the file's own pixel hash if it has one, see inference_cache_key
     try:
-        model = WAIFU_MODELS['wd14-vit-v2']
-        ratings, tags = model.interrogate(image)
-
-        filtered_tags = {
-            tag: score for tag, score in tags.items()
-            if score >= .35
-        }
+        model = WAIFU_MODELS[model_name]
+        model.draft(image)
+        cache = get_inference_cache()
+        if cache is None:
+            ratings, tags = model.interrogate(image)
+            return wd14_tags_to_text(ratings, tags)
+
+        cache_key = model_name + ':' + model.source
+        pixel_hash = inference_cache_key(image, pixel_hash)
+        confidence = cache.get(cache_key, pixel_hash)
+        if confidence is None:
+            confidence = model.confidence_batch([image])[0]
+            cache.put(cache_key, pixel_hash, confidence)
+        else:
+            logger.info("image_to_wd14_tags: " + filename + " found in the inference cache")
 
-        text_items = []
-        tags_pairs = filtered_tags.items()
-        tags_pairs = sorted(tags_pairs, key=lambda x: (-x[1], x[0]))
-        for tag, score in tags_pairs:
-            tag_outformat = tag
-            tag_outformat = tag_outformat.replace('_', ' ')
-            tag_outformat = re.sub(RE_SPECIAL, r'\\\1', tag_outformat)
-            text_items.append(tag_outformat)
-        output_text = ', '.join(text_items)
-
-        return ratings, output_text, filtered_tags
+        return model.postprocess(confidence)
     except Exception as e:
         logger.error("Exception getting tags from image " + filename + ". " + str(e))
 
+def inference_cache_key(image, pixel_hash=None):
+    # The inference cache is keyed on the pixel hash exiftool_hash wrote to the file,
+    # read with its other metadata, so files hashed before don't need hashing again.
+    # Files without one are keyed on the hash of the image after model.draft, the
+    # reduced pixels the model sees.
+    return pixel_hash or pixelhash.hash_pixels(image)
+
+class InferenceBatcher:
+    """
+    Collects preprocessed images from worker threads and runs them through the model
+    in batches.  submit() returns a Future that gets the same
+    (ratings, output_text, filtered_tags) tuple image_to_wd14_tags returns, so each
+    worker carries on with the exiftool writes for its own file.
+    """
+    def __init__(self, model_name='wd14-vit-v2', batch_size=WD14_BATCH_SIZE, timeout=WD14_BATCH_TIMEOUT,
+                 max_pending=None, stats=None, cache=None):
+        self.model = WAIFU_MODELS[model_name]
+        self.cache = cache
+        self.cache_key = model_name + ':' + self.model.source
+        self.batch_size = batch_size
+        self.timeout = timeout
+        # submit() blocks while this many images are waiting, None for no limit
+        self.max_pending = max_pending
+        self.stats = stats
+        self._condition = threading.Condition()
+        self._pending = []
+        self._oldest = None
+        self._closed = False
+        self.batches = 0
+        self.images = 0
+        self._thread = threading.Thread(target=self._loop, name="wd14-batcher", daemon=True)
+        self._thread.start()
+
+    def cached(self, pixel_hash):
+        # An already finished Future if the cache has this image's result, otherwise None
+        if self.cache is None or pixel_hash is None:
+            return None
+        confidence = self.cache.get(self.cache_key, pixel_hash)
+        if confidence is None:
+            return None
+        future = concurrent.futures.Future()
+        future.set_result(self.model.postprocess(confidence))
+        return future
+
+    def submit(self, filename, image: np.ndarray, pixel_hash=None) -> concurrent.futures.Future:
+        # With a pixel_hash and a cache, the result is stored in the cache
+        future = concurrent.futures.Future()
+        with self._condition:
+            while self.max_pending is not None and len(self._pending) >= self.max_pending and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise RuntimeError("InferenceBatcher is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((filename, image, pixel_hash, future))
+            self._condition.notify_all()
+        return future
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._pending:
+                    waited = time.monotonic() - self._oldest
+                    full = len(self._pending) >= self.batch_size or (
+                        self.max_pending is not None and len(self._pending) >= self.max_pending)
+                    if full or waited >= self.timeout or self._closed:
+                        break
+                    self._condition.wait(self.timeout - waited)
+                elif self._closed:
+                    return None
+                else:
+                    self._condition.wait()
+            batch = self._pending[:self.batch_size]
+            self._pending = self._pending[self.batch_size:]
+            self._oldest = time.monotonic() if self._pending else None
+            self._condition.notify_all()
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            filenames = [filename for filename, image, pixel_hash, future in batch]
+            start = time.perf_counter()
+            try:
+                confidences = self.model.confidence_batch([image for filename, image, pixel_hash, future in batch])
+            except Exception as e:
+                logger.error("Exception running WD14 batch of " + str(len(batch)) + " images: " + ", ".join(filenames) + ". " + str(e))
+                if self.stats is not None:
+                    self.stats.record(time.perf_counter() - start, False, len(batch))
+                for filename, image, pixel_hash, future in batch:
+                    future.set_exception(e)
+                continue
+            if self.stats is not None:
+                self.stats.record(time.perf_counter() - start, True, len(batch))
+            self.batches += 1
+            self.images += len(batch)
+            logger.debug("InferenceBatcher: ran batch of " + str(len(batch)) + " images")
+            try:
+                results = self.model.postprocess_batch(confidences)
+            except Exception as e:
+                logger.error("Exception post-processing WD14 batch of " + str(len(batch)) + " images: " + ", ".join(filenames) + ". " + str(e))
+                for filename, image, pixel_hash, future in batch:
+                    future.set_exception(e)
+                continue
+            for (filename, image, pixel_hash, future), confidence, result in zip(batch, confidences, results):
+                if self.cache is not None and pixel_hash is not None:
+                    self.cache.put(self.cache_key, pixel_hash, confidence)
+                future.set_result(result)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        logger.info("InferenceBatcher: " + str(self.images) + " images in " + str(self.batches) + " batches")
+
 def check_and_del_text_file(file_path, words):
     # Check if the file exists
     try:
@@ -356,19 +752,17 @@ def move_file_to_prefixed_folder(filepath, text_string):
 
     os.makedirs(new_folder_path, exist_ok=True)
     shutil.move(rel_filepath, new_file_path)
+    return os.path.abspath(new_file_path)
 
 def exiftool_del_dupetags(path):
     logger.info("exiftool_del_dupetags: " + path + ": Removing duplicate tags")
     try:
-        exiftool = exiftool.ExifTool()
-        exiftool.overwrite_original()
-        exiftool.set_tags('-P',
-                          '-XMP:Subject<${XMP:Subject;NoDups(1)}',
-                          '-IPTC:Keywords<${IPTC:Keywords;NoDups(1)}',
-                          '-XMP:CatalogSets<${XMP:CatalogSets;NoDups(1)}',
-                          '-XMP:TagsList<${XMP:TagsList;NoDups(1)}')
-        exiftool.execute([path])
-        output = exiftool.get_output()
+        output = et_pool.execute('-P', '-overwrite_original',
+                                 '-XMP:Subject<${XMP:Subject;NoDups(1)}',
+                                 '-IPTC:Keywords<${IPTC:Keywords;NoDups(1)}',
+                                 '-XMP:CatalogSets<${XMP:CatalogSets;NoDups(1)}',
+                                 '-XMP:TagsList<${XMP:TagsList;NoDups(1)}',
+                                 path)
         logger.info("exiftool_del_dupetags MODIFY success: " + path + ". output: " + output)
         
     except Exception as e:
@@ -380,11 +774,7 @@ def exiftool_del_dupetags(path):
 def exiftool_copy_XMPSubject_to_TagsList(path):
     logger.info("exiftool_copy_tags_to_TagsList: " + path + ": Removing duplicate tags")
     try:
-        ex = exiftool.ExifToolHelper()
-        ex.common_args(["-P","-G", "-n", "-overwrite_original", '-sep', '##'])
-        ex.set_tags('-XMP:TagsList<${XMP:Subject;NoDups(1)}')
-        ex.execute([path])
-        output = ex.get_output()
+        output = et_pool.execute("-P", "-overwrite_original", '-sep', '##', '-XMP:TagsList<${XMP:Subject;NoDups(1)}', path)
         logger.info("exiftool_copy_tags_to_TagsList MODIFY success XMP: " + path + ". output: " + output)
         
     except Exception as e:
@@ -393,33 +783,270 @@ def exiftool_copy_XMPSubject_to_TagsList(path):
 
     return True
 
-def exiftool_is_photo_tagged(photo_path):
+TAG_FIELDS = ('XMP:Subject', 'IPTC:Keywords', 'XMP:CatalogSets', 'XMP:TagsList')
+
+class ExifSnapshot:
+    """
+    Everything combo.py decides on for one image, read with a single exiftool call:
+    the XMP-acdsee:tagged processed marker, the four tag lists and the pixel hash
+    exiftool_hash writes.  Pass it to the exiftool_* helpers so they work from memory
+    instead of asking exiftool again.
+    """
+    READ_TAGS = ['XMP-acdsee:tagged', 'XMP-et:OriginalImageMD5'] + list(TAG_FIELDS)
+
+    def __init__(self, path, tagged=False, tags=None, pixel_hash=None):
+        self.path = path
+        self.tagged = tagged
+        self.tags = tags if tags is not None else {tag_type: [] for tag_type in TAG_FIELDS}
+        self.pixel_hash = pixel_hash
+
+    @classmethod
+    def read(cls, path):
+        ret = et_pool.get_tags(path, cls.READ_TAGS, params=["-P","-G", "-n", "-overwrite_original"])
+        return cls.from_exiftool(path, ret[0] if ret else {})
+
+    @classmethod
+    def from_exiftool(cls, path, metadata):
+        # Missing tags are left out of exiftool's output, a single value is not a list
+        # and -n turns numeric looking tags into numbers
+        tags = {}
+        for tag_type in TAG_FIELDS:
+            value = metadata.get(tag_type, [])
+            tags[tag_type] = [str(v) for v in value] if isinstance(value, list) else [str(value)]
+        tagged = metadata.get('XMP:Tagged')
+        pixel_hash = metadata.get('XMP:OriginalImageMD5')
+        return cls(path, tagged is True or str(tagged).lower() == 'true', tags, str(pixel_hash) if pixel_hash else None)
+
+    def missing(self, tags):
+        # (tag_type, tag) pairs for every tag that isn't in every field yet
+        missing = []
+        for tag_type, existing_tags_list in self.tags.items():
+            for tag in tags:
+                tag = tag.strip()
+                if tag and tag not in existing_tags_list:
+                    missing.append((tag_type, tag))
+        return missing
+
+    def duplicate_tags(self):
+        duplicate_tags = {}
+        for tag_type, existing_tags_list in self.tags.items():
+            for tag in existing_tags_list:
+                if tag and existing_tags_list.count(tag) > 1:
+                    if tag not in duplicate_tags:
+                        duplicate_tags[tag] = {
+                            'count': existing_tags_list.count(tag),
+                            'tag_type': [tag_type]
+                        }
+                    else:
+                        duplicate_tags[tag]['count'] += existing_tags_list.count(tag)
+                        duplicate_tags[tag]['tag_type'].append(tag_type)
+        return duplicate_tags
+
+def exiftool_read_snapshots(paths):
+    # ExifSnapshot for many files with one exiftool call.  Files that couldn't be read
+    # are left out of the result.
+    snapshots = {}
+    if not paths:
+        return snapshots
+    try:
+        ret = et_pool.get_tags(paths, ExifSnapshot.READ_TAGS, params=["-P","-G", "-n", "-overwrite_original"])
+    except Exception as e:
+        # exiftool fails the whole command if any one file is bad, so find out which
+        logger.warning("exiftool_read_snapshots: batch read of " + str(len(paths)) + " files failed, reading one at a time. " + str(e))
+        for path in paths:
+            try:
+                snapshots[path] = ExifSnapshot.read(path)
+            except Exception as e:
+                logger.error("exiftool_read_snapshots: " + path + ". Error " + str(e) + ".")
+        return snapshots
+    # exiftool reports SourceFile with forward slashes on Windows
+    by_name = {os.path.normpath(path): path for path in paths}
+    for metadata in ret:
+        path = by_name.get(os.path.normpath(metadata.get('SourceFile', '')))
+        if path is not None:
+            snapshots[path] = ExifSnapshot.from_exiftool(path, metadata)
+    return snapshots
+
+def tag_update_args(missing):
+    # exiftool arguments adding (tag_type, tag) pairs from ExifSnapshot.missing.  The
+    # -= first stops a tag that is already there being added twice.
+    args = []
+    for tag_type, tag in missing:
+        args.append(f'-{tag_type}-={tag}')
+        args.append(f'-{tag_type}+={tag}')
+    return args
+
+class ExifBatchWriter:
+    """
+    Sends the same exiftool write to many files in one command.  Files are grouped by
+    identical arguments and written batch_size at a time; exiftool gets its arguments
+    through the -stay_open argfile, so there is no command line limit to work around.
+    Each batch is read back with one call and every file's check(snapshot) decides
+    whether the write took for that file, so one bad file doesn't fail the others.
+    """
+    def __init__(self, batch_size=EXIFTOOL_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.commands = 0
+        self.written = 0
+        self.failed = 0
+
+    def write(self, items):
+        """
+        items are (path, args, check).  Yields (path, ok, snapshot) for each, snapshot
+        being the read back metadata or None if the file couldn't be read.
+        """
+        groups = {}
+        for path, args, check in items:
+            group = groups.setdefault(tuple(args), [])
+            group.append((path, check))
+            if len(group) >= self.batch_size:
+                yield from self._write_batch(args, groups.pop(tuple(args)))
+        for args, group in groups.items():
+            yield from self._write_batch(args, group)
+
+    def _write_batch(self, args, group):
+        paths = [path for path, check in group]
+        try:
+            output = et_pool.execute("-P", "-overwrite_original", *args, *paths)
+            logger.debug("ExifBatchWriter: " + str(len(paths)) + " files. " + str(args) + ". output: " + output.strip())
+        except Exception as e:
+            # Some files may still have been written, the read back sorts it out
+            logger.error("ExifBatchWriter: write to " + str(len(paths)) + " files reported errors. " + str(e))
+        self.commands += 1
+
+        snapshots = exiftool_read_snapshots(paths)
+        for path, check in group:
+            snapshot = snapshots.get(path)
+            ok = snapshot is not None and check(snapshot)
+            if ok:
+                self.written += 1
+            else:
+                self.failed += 1
+                logger.error("ExifBatchWriter: " + path + " FAILED. " + str(args))
+            yield path, ok, snapshot
+
+def exiftool_mark_tagged_batch(paths, batch_size=EXIFTOOL_BATCH_SIZE):
+    # Batched exiftool_make_photo_tagged.  Yields (path, ok)
+    writer = ExifBatchWriter(batch_size)
+    items = ((path, ['-XMP-acdsee:tagged=True'], lambda snapshot: snapshot.tagged) for path in paths)
+    for path, ok, snapshot in writer.write(items):
+        if ok:
+            record_outcome(path, processingstate.TAGGED)
+        yield path, ok
+
+def pixel_hash_args(path, pixel_hash):
+    # exiftool arguments writing pixel_hash to path on its own
+    return ['-EXIF:RawImageDigest<$imagedatamd5', '-XMP-et:OriginalImageMD5=' + pixel_hash,
+            '-XMP:EmbeddedXMPDigest=' + pixel_hash, path]
+
+def write_pixel_hashes(pixel_hashes, batch_size=EXIFTOOL_BATCH_SIZE):
+    """
+    Batched exiftool_hash write.  pixel_hashes is {path: pixel hash}.  Every file gets
+    a different value, so rather than one write per file the hashes go in a CSV that
+    exiftool imports with -csv=, which makes the whole batch a single ExifBatchWriter
+    command.  Returns {path: 'succeeded'|'failed'}.
+    """
+    writer = ExifBatchWriter(batch_size)
+    results = {}
+    paths = list(pixel_hashes)
+    for i in range(0, len(paths), batch_size):
+        chunk = paths[i:i + batch_size]
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', encoding='utf-8', delete=False) as f:
+            rows = csv.writer(f)
+            rows.writerow(['SourceFile', 'XMP-et:OriginalImageMD5', 'XMP:EmbeddedXMPDigest'])
+            for path in chunk:
+                # exiftool matches SourceFile with forward slashes on Windows
+                rows.writerow([path.replace(os.sep, '/'), pixel_hashes[path], pixel_hashes[path]])
+        args = ['-csv=' + f.name, '-EXIF:RawImageDigest<$imagedatamd5']
+        try:
+            items = ((path, args, lambda snapshot, pixel_hash=pixel_hashes[path]: snapshot.pixel_hash == pixel_hash)
+                     for path in chunk)
+            for path, ok, snapshot in writer.write(items):
+                if ok:
+                    record_outcome(path, processingstate.HASHED)
+                results[path] = 'succeeded' if ok else 'failed'
+        finally:
+            os.remove(f.name)
+    logger.info("write_pixel_hashes: " + str(len(paths)) + " files, " + str(writer.written) + " written, "
+                + str(writer.failed) + " failed, " + str(writer.commands) + " exiftool writes")
+    return results
+
+def tag_files(image_paths, tags_for, batch_size=EXIFTOOL_BATCH_SIZE):
+    """
+    Batched Add_a_Tag.  tags_for(path) returns the tags for that file.  Per batch it
+    takes one read, one write per distinct set of missing tags, one read back, and one
+    write to remove duplicate tags where there are any.  Returns {path: outcome}, one of
+    'succeeded', 'failed', or 'skipped' when the file already had the tags.
+    """
+    writer = ExifBatchWriter(batch_size)
+    results = {}
+    for i in range(0, len(image_paths), batch_size):
+        chunk = image_paths[i:i + batch_size]
+        snapshots = exiftool_read_snapshots(chunk)
+        items = []
+        for path in chunk:
+            snapshot = snapshots.get(path)
+            if snapshot is None:
+                logger.error("tag_files: couldn't read " + path + ". FAILED")
+                results[path] = 'failed'
+                continue
+            tags = tags_for(path)
+            missing = snapshot.missing(tags)
+            if missing:
+                items.append((path, tag_update_args(missing), lambda snapshot, tags=tags: not snapshot.missing(tags)))
+            else:
+                logger.info(path + ":  tag_files. Nothing to do, tags (" + str(tags) + ") are correct")
+                results[path] = 'skipped'
+        for path, ok, snapshot in writer.write(items):
+            results[path] = 'succeeded' if ok else 'failed'
+            snapshots[path] = snapshot
+
+        # The same NoDups rewrite works for every file, so it's one more batched write
+        dupes = [path for path in chunk if results[path] != 'failed' and snapshots[path].duplicate_tags()]
+        if dupes:
+            logger.info("tag_files: removing duplicate tags from " + str(len(dupes)) + " files")
+            dedupe = ['-XMP:Subject<${XMP:Subject;NoDups(1)}', '-IPTC:Keywords<${IPTC:Keywords;NoDups(1)}',
+                      '-XMP:CatalogSets<${XMP:CatalogSets;NoDups(1)}', '-XMP:TagsList<${XMP:TagsList;NoDups(1)}']
+            for path, ok, snapshot in writer.write((path, dedupe, lambda snapshot: not snapshot.duplicate_tags()) for path in dupes):
+                if not ok:
+                    logger.error("tag_files: duplicate tags remain in " + path)
+    logger.info("tag_files: " + str(len(image_paths)) + " files, " + str(writer.written) + " written, "
+                + str(writer.failed) + " failed, " + str(writer.commands) + " exiftool writes")
+    return results
+
+def exiftool_is_photo_tagged(photo_path, snapshot=None):
     try:
-        et =  exiftool.ExifToolHelper()
-        ret = et.get_tags(files=photo_path, tags="XMP-acdsee:tagged",params=["-P","-G", "-n", "-overwrite_original"])[0]['XMP:Tagged']
+        if snapshot is None:
+            snapshot = ExifSnapshot.read(photo_path)
 
-        if ret == None:
-            return False
-        elif ret == True:
+        if snapshot.tagged:
             return True
         else:
             logger.info(photo_path + " is not tagged as processed. ")
             return False
     except Exception as e:
-        logger.error("Exception exiftool_is_photo_tagged: " + photo_path + ". Error " + str(e.returncode) + ". " + str(e.output) + ".")
+        logger.error("Exception exiftool_is_photo_tagged: " + photo_path + ". Error " + str(e) + ".")
         # move_file_to_prefixed_folder(photo_path, 'badfiles')
         return False
 
-def exiftool_make_photo_tagged(photo_path):
-    if exiftool_is_photo_tagged(photo_path):
+def exiftool_make_photo_tagged(photo_path, snapshot=None):
+    if exiftool_is_photo_tagged(photo_path, snapshot):
         print("Photo Already tagged")
-    else:
-        with exiftool.ExifToolHelper() as et:
-            et.set_tags(
-                files=photo_path,
-                params=["-P","-G", "-n", "-overwrite_original"],
-                tags={"XMP-acdsee:tagged": ["False"]}
-            )    
+        record_outcome(photo_path, processingstate.TAGGED)
+        return True
+    try:
+        et_pool.set_tags(
+            photo_path,
+            {"XMP-acdsee:tagged": ["True"]},
+            params=["-P","-G", "-n", "-overwrite_original"]
+        )
+    except Exception as e:
+        logger.error("Exception exiftool_make_photo_tagged: " + photo_path + ". Error " + str(e) + ".")
+        return False
+    if snapshot is not None:
+        snapshot.tagged = True
+    record_outcome(photo_path, processingstate.TAGGED)
+    return True
 
 
 def exiftool_hash(path):
@@ -427,35 +1054,23 @@ def exiftool_hash(path):
     print("creating hash for " + path)
     #image_path = os.path.join(root, picture_path)
     try:
-        with Image.open(path).convert('RGB') as image:
-            # Get the image data as bytes
-            image_bytes = image.tobytes()
-        # Create a hash object and update with image bytes
-        hash_object = hashlib.blake2b(image_bytes)
-        hash_value = hash_object.hexdigest()
-
-        with exiftool.ExifTool(common_args=["-P","-G", "-n", "-overwrite_original",]) as ex:
-            res = (ex.execute(*['-EXIF:RawImageDigest<$imagedatamd5','-XMP-et:OriginalImageMD5='+ hash_value,'-XMP:EmbeddedXMPDigest='+ hash_value] + [path]))
-            logger.info("Result for " + path + " with hash " + hash_value + " was " + (res))
-            print("Result for " + path + " with hash " + hash_value + " was " + (res))
+        hash_value = pixelhash.hash_image(path)
 
+        res = et_pool.execute("-P", "-overwrite_original", *pixel_hash_args(path, hash_value))
+        logger.info("Result for " + path + " with hash " + hash_value + " was " + (res))
+        print("Result for " + path + " with hash " + hash_value + " was " + (res))
+        record_outcome(path, processingstate.HASHED)
+        return True
 
     except Exception as e:
-        logger.error("Exception " + str(e.returncode) + ". " + str(e.output) + ". From " + path)
+        logger.error("Exception " + str(e) + ". From " + path)
         return False
 
 
 def exiftool_batch_untag(path):
     try:
-
-        ex = exiftool.ExifToolHelper()
-        ex.overwrite_original()
-        ex.set_tags('-P', '-s', '-XMP-acdsee:tagged=False', '-r', path)
-        ex.execute([])
-        output = ex.get_output()
-        
-
-        output = output.decode().strip()
+        output = et_pool.execute('-P', '-s', '-overwrite_original', '-XMP-acdsee:tagged=False', '-r', path)
+        output = output.strip()
         logger.info(path + ". Wasn't tagged. Trying to tag as False! Output: " + output)
         if 'updated' in output.lower():
             logger.info(path + ". Successfully MODIFY tagged as False! Output: " + output)
@@ -464,66 +1079,41 @@ def exiftool_batch_untag(path):
             return False
 
     except Exception as e:
-        logger.error("Exception " + str(e.returncode) + ". " + str(e.output) + ". From " + path)
+        logger.error("Exception " + str(e) + ". From " + path)
         return False
 
 
 
 
-def exiftool_get_existing_tags(img_path):
+def exiftool_get_existing_tags(img_path, snapshot=None):
 
-    et =  exiftool.ExifToolHelper()
-    ret = et.get_tags(files=img_path, tags={'XMP:Subject','IPTC:Keywords','XMP:CatalogSets','XMP:TagsList'},params=["-P","-G", "-n", "-overwrite_original"])
+    if snapshot is None:
+        snapshot = ExifSnapshot.read(img_path)
+    tags_dict = snapshot.tags
 
-    if ret != '':
-        tags_dict = {
-                'XMP:Subject': [],
-                'IPTC:Keywords': [],
-                'XMP:CatalogSets': [],
-                'XMP:TagsList': []
-            }
-
-        tags_dict['XMP:Subject'] = ret[0]['XMP:Subject']
-        tags_dict['IPTC:Keywords']  = ret[0]['IPTC:Keywords']
-        tags_dict['XMP:CatalogSets']  = ret[0]['XMP:CatalogSets']
-        tags_dict['XMP:TagsList']  = ret[0]['XMP:TagsList']
-
-        logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output XMP:Subject      :" + str(tags_dict['XMP:Subject']))
-        logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output IPTC:Keywords    :" + str(tags_dict['IPTC:Keywords']))
-        logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output XMP:CatalogSets :" + str(tags_dict['XMP:CatalogSets']))
-        logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output XMP:TagsList    :" + str(tags_dict['XMP:TagsList']))
-
-        return tags_dict
-    else:
-        return None
+    logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output XMP:Subject      :" + str(tags_dict['XMP:Subject']))
+    logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output IPTC:Keywords    :" + str(tags_dict['IPTC:Keywords']))
+    logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output XMP:CatalogSets :" + str(tags_dict['XMP:CatalogSets']))
+    logger.debug(img_path + ". exiftool_get_existing_tags Exiftool output XMP:TagsList    :" + str(tags_dict['XMP:TagsList']))
+
+    return tags_dict
 
     
-def exiftool_Update_tags(img_path, tags):
-#    cmd = ['-overwrite_original', '-P']
-    cmd = ['']
-    existing_tags = exiftool_get_existing_tags(img_path)
-    updated = False
-
-    if existing_tags == None:
-        print("no preexisting tags")
-        cmd.append(f'-{tag_type}-="{tag}"')
-        cmd.append(f'-{tag_type}+="{tag}"')
-        updated = True
-    else:
-        for tag_type, existing_tags_list in existing_tags.items():
-            for tag in tags:
-                tag = tag.strip()
-                if tag and tag not in existing_tags_list:
-                    logger.debug("exiftool_Update_tags: need to add " + tag_type + " field " + tag + " to " + img_path)
-                    cmd.append(f'-{tag_type}-="{tag}"')
-                    cmd.append(f'-{tag_type}+="{tag}"')
-                    updated = True
+def exiftool_Update_tags(img_path, tags, snapshot=None):
+    cmd = ['-overwrite_original', '-P']
+    if snapshot is None:
+        snapshot = ExifSnapshot.read(img_path)
+    missing = snapshot.missing(tags)
+    updated = bool(missing)
+
+    for tag_type, tag in missing:
+        logger.debug("exiftool_Update_tags: need to add " + tag_type + " field " + tag + " to " + img_path)
+    cmd += tag_update_args(missing)
 
     if updated:
-        ex = exiftool.ExifToolHelper()
-        ex.execute(cmd + [img_path])
-        output = ex.get_output()
-        
+        # Arguments go to exiftool one per line, so no shell quoting around the tags
+        output = et_pool.execute(*cmd, img_path)
+
         logger.debug("exiftool_Update_tags command line was " + str(cmd + [img_path]))
         logger.info("exiftool_Update_tags  MODIFY" + img_path + ". Exiftool update completed successfully.")
         logger.debug("exiftool_Update_tags  MODIFY" + img_path + ". Exiftool update completed successfully. " + str(output))
@@ -532,9 +1122,10 @@ def exiftool_Update_tags(img_path, tags):
         logger.info(img_path + ":  exiftool_Update_tags. Nothing to do, tags (" + str(tags) + ") are correct")
         return True
 
-def are_tags_correct(img_path, tags):
+def are_tags_correct(img_path, tags, snapshot=None):
+    # Without a snapshot the tags are read back from the file
     try:
-        existing_tags = exiftool_get_existing_tags(img_path)
+        existing_tags = exiftool_get_existing_tags(img_path, snapshot)
 
         tags_dict = {
             'XMP:Subject': [],
@@ -565,27 +1156,14 @@ def are_tags_correct(img_path, tags):
             return True
 
     except Exception as e:
-        logger.error("Exception in are_tags_correct: " + img_path + ". Error " + str(e.returncode) + " removing duplicate tags: " + str(e.output) + ".")
+        logger.error("Exception in are_tags_correct: " + img_path + ". Error " + str(e) + ".")
         return False
     
-def find_duplicate_tags_in_file(img_path):
+def find_duplicate_tags_in_file(img_path, snapshot=None):
     try:
-        existing_tags = exiftool_get_existing_tags(img_path)
-        duplicate_tags = {}
-
-        for tag_type, existing_tags_list in existing_tags.items():
-            #logger.debug(img_path + " find_duplicate_tags_in_file tag_type:" + tag_type + " .  existing_tags_list:" + str(existing_tags_list))
-            for tag in existing_tags_list:
-                #logger.debug(img_path + " find_duplicate_tags_in_file tag:" + tag_type + ":" + tag)
-                if tag and existing_tags_list.count(tag) > 1:
-                    if tag not in duplicate_tags:
-                        duplicate_tags[tag] = {
-                            'count': existing_tags_list.count(tag),
-                            'tag_type': [tag_type]
-                        }
-                    else:
-                        duplicate_tags[tag]['count'] += existing_tags_list.count(tag)
-                        duplicate_tags[tag]['tag_type'].append(tag_type)
+        if snapshot is None:
+            snapshot = ExifSnapshot.read(img_path)
+        duplicate_tags = snapshot.duplicate_tags()
 
         if duplicate_tags:
             logger.info("find_duplicate_tags_in_file: Duplicate tags found in " + img_path)
@@ -601,16 +1179,23 @@ def find_duplicate_tags_in_file(img_path):
         logger.error("find_duplicate_tags_in_file Exception:" + str(e))
 
 
-def process_file(image_path):
+def prepare_file(image_path):
+    # Everything before inference.  Returns True if the file needs nothing more, False
+    # if it failed, otherwise (opened image, ExifSnapshot) for finish_file.
     #image_path = 'C:\\Users\\Simon\\Downloads\\w6bgPUV.png'
     reprocess = False
     logger.info("Processfile " + " START Processing " + image_path)
     output_file = os.path.splitext(image_path)[0] + ".txt"
 
+    try:
+        snapshot = ExifSnapshot.read(image_path)
+    except Exception as e:
+        logger.error("Processfile exiftool read FAILED for " + image_path + ". " + str(e))
+        return False
 
-    if exiftool_is_photo_tagged(image_path) and not reprocess:
+    if exiftool_is_photo_tagged(image_path, snapshot) and not reprocess:
         logger.info(image_path + " is already tagged")
-        if find_duplicate_tags_in_file(image_path) :
+        if find_duplicate_tags_in_file(image_path, snapshot) :
             logger.debug("Processfile " +  "There were duplicate tags in " + image_path)
             exiftool_del_dupetags(image_path)
         else:
@@ -620,6 +1205,7 @@ def process_file(image_path):
             logger.info(image_path + ".  Need to process as there is a " + output_file + " file which could be deleted.")
         else:
             logger.info(image_path + ".  File is tagged as processed.  No dupe tags.  No txt file.  Finished.  Success.")
+            record_outcome(image_path, processingstate.TAGGED)
             return True
 
     else:
@@ -630,17 +1216,20 @@ def process_file(image_path):
         logger.info("image: " + image_path + " successfully opened.  Continue processing ")
     except Exception as e:
         logger.error("Processfile Exception1: " + " failed to open image : " + image_path + ". FAILED Error: " + str(e) + ".  Skipping")
-        move_file_to_prefixed_folder(image_path, 'badfiles')
+        # Recorded where it now is, badfiles/ is often inside the scanned tree
+        record_outcome(move_file_to_prefixed_folder(image_path, 'badfiles'), processingstate.BAD_FILE)
         return False
 
-    try:
-        gr_ratings, gr_output_text, gr_tags = image_to_wd14_tags(image_path, image)
-        #gr_output_text = gr_output_text + ',tagged'
-        tagdict = gr_output_text.split(",")
-        logger.info("Processfile tag extract success. " + image_path + ".  caption: " + gr_output_text)
-    except Exception as e:
-        logger.error("Processfile tag extraction for " + image_path + " didn't work. FAILED  Skipping")
-        return False
+    return image, snapshot
+
+def finish_file(image_path, gr_output_text, snapshot=None, mark=True):
+    # Everything after inference: write the tags, check them, tidy the .txt file and
+    # mark the image as processed.  snapshot is prepare_file's read of the metadata.
+    # With mark=False the caller marks it, e.g. with exiftool_mark_tagged_batch
+    output_file = os.path.splitext(image_path)[0] + ".txt"
+    #gr_output_text = gr_output_text + ',tagged'
+    tagdict = gr_output_text.split(",")
+    logger.info("Processfile tag extract success. " + image_path + ".  caption: " + gr_output_text)
 
     try:
         tagdict = [substr for substr in tagdict if substr]
@@ -649,7 +1238,11 @@ def process_file(image_path):
         return False
 
     try:
-        ret =  exiftool_Update_tags(image_path, tagdict)
+        if snapshot is None:
+            snapshot = ExifSnapshot.read(image_path)
+        # Only a write needs checking against a fresh read
+        written = bool(snapshot.missing(tagdict))
+        ret =  exiftool_Update_tags(image_path, tagdict, snapshot)
         if ret == True:
             logger.info("exiftool_Update_tags success. " + image_path + ".")
         else:
@@ -660,7 +1253,7 @@ def process_file(image_path):
         return False
     
     try:
-        ret = are_tags_correct(image_path, tagdict)
+        ret = are_tags_correct(image_path, tagdict, None if written else snapshot)
         if ret == True:
             logger.info(image_path + " tags added correctly " + str(ret))
         else:
@@ -681,9 +1274,12 @@ def process_file(image_path):
         logger.error("Processfile check_and_del_text_file FAILED.  Not marking as tagged. Exception. " + ". " + image_path + ". " + str(e) )
         return False
 
+    if not mark:
+        return True
+
     try:
         logger.info(image_path + ".  If I got here then previous steps were successful.  Mark as processed")      
-        ret = exiftool_make_photo_tagged('True',image_path)
+        ret = exiftool_make_photo_tagged(image_path, snapshot)
         if ret == True:
             logger.info("Processfile " + " SUCCESS marking as processed " + image_path + ". " + str(ret))
             return True
@@ -694,19 +1290,342 @@ def process_file(image_path):
         logger.error("Processfile exiftool_make_photo_tagged FAILED Exception. " + ". " + image_path + ". " + str(e) )
         return False
 
+def process_file(image_path):
+    prepared = prepare_file(image_path)
+    if prepared is True or prepared is False:
+        return prepared
+    image, snapshot = prepared
+
+    try:
+        gr_ratings, gr_output_text, gr_tags = image_to_wd14_tags(image_path, image, pixel_hash=snapshot.pixel_hash)
+    except Exception as e:
+        logger.error("Processfile tag extraction for " + image_path + " didn't work. FAILED  Skipping")
+        return False
+
+    return finish_file(image_path, gr_output_text, snapshot)
+
+class StageStats:
+    # Per stage counters for ImagePipeline, updated from that stage's threads
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        self.skipped = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok=True, items=1):
+        self.add(seconds, succeeded=items if ok else 0, failed=0 if ok else items)
+
+    def add(self, seconds, succeeded=0, failed=0, skipped=0):
+        with self._lock:
+            self.items += succeeded + failed + skipped
+            self.failed += failed
+            self.skipped += skipped
+            self.busy += seconds
+
+    def summary(self, elapsed):
+        rate = self.items / elapsed if elapsed > 0 else 0
+        per_item = self.busy / self.items if self.items else 0
+        return (f"{self.name}: {self.items} items ({self.items - self.failed - self.skipped} succeeded, "
+                f"{self.failed} failed, {self.skipped} skipped), {rate:.2f} items/s, "
+                f"{per_item:.3f} s/item busy, {self.workers} workers")
+
+def _timed_call(func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def run_tasks(tasks, stages, total=None, workers=TASK_WORKERS, window=None):
+    """
+    Run (stage, items, func, args) tasks from the tasks iterable on a thread pool.  At
+    most window tasks are submitted at a time, so a huge directory doesn't queue a
+    future per file up front, and progress comes from tasks completing rather than
+    polling them.  A func returns a dict of {path: 'succeeded'|'failed'|'skipped'}, or
+    True/False for a single file.  Returns {stage: StageStats}.
+    """
+    from tqdm import tqdm
+
+    window = window or 2 * workers
+    stats = {stage: StageStats(stage, workers) for stage in stages}
+    running = {}
+    start = time.perf_counter()
+
+    def finished(future, pbar):
+        stage, items = running.pop(future)
+        try:
+            result, seconds = future.result()
+        except Exception as e:
+            logger.error("run_tasks: " + stage + " task for " + str(items) + " files FAILED. " + str(e))
+            stats[stage].add(0, failed=items)
+        else:
+            if isinstance(result, dict):
+                outcomes = Counter(result.values())
+                stats[stage].add(seconds, outcomes['succeeded'], outcomes['failed'], outcomes['skipped'])
+            else:
+                stats[stage].record(seconds, result is not False, items)
+        pbar.update(items)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, tqdm(total=total) as pbar:
+        for stage, items, func, args in tasks:
+            while len(running) >= window:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finished(future, pbar)
+            running[executor.submit(_timed_call, func, args)] = (stage, items)
+        for future in concurrent.futures.as_completed(list(running)):
+            finished(future, pbar)
+    # The pool's threads have exited, their exiftools would sit idle until the end
+    et_pool.close_finished_threads()
+
+    elapsed = time.perf_counter() - start
+    for stage in stats.values():
+        logger.info("run_tasks " + stage.summary(elapsed))
+    return stats
+
+def hash_files(image_paths, total=None, workers=HASH_WORKERS, batch_size=EXIFTOOL_BATCH_SIZE):
+    """
+    Hash mode.  pixelhash.hash_images decodes and hashes in a process pool while this
+    thread writes the finished hashes batch_size files at a time with
+    write_pixel_hashes, so hashing doesn't wait for exiftool or the other way round.
+    Returns the hash StageStats.
+    """
+    from tqdm import tqdm
+
+    stats = StageStats('hash', workers)
+    start = time.perf_counter()
+    pending = {}
+
+    def write(pbar):
+        write_start = time.perf_counter()
+        outcomes = Counter(write_pixel_hashes(pending, batch_size).values())
+        stats.add(time.perf_counter() - write_start, outcomes['succeeded'], outcomes['failed'])
+        pbar.update(len(pending))
+        pending.clear()
+
+    with tqdm(total=total) as pbar:
+        for path, pixel_hash, error in pixelhash.hash_images(image_paths, workers):
+            if error is not None:
+                logger.error("hash_files: " + path + ". Error " + str(error) + ".")
+                stats.add(0, failed=1)
+                pbar.update(1)
+                continue
+            pending[path] = pixel_hash
+            if len(pending) >= batch_size:
+                write(pbar)
+        if pending:
+            write(pbar)
+
+    logger.info("hash_files " + stats.summary(time.perf_counter() - start))
+    return stats
+
+class ImagePipeline:
+    """
+    Normal tagging mode as three stages joined by bounded queues:
+      decode  - decode_workers threads: metadata checks, open and preprocess the image
+      infer   - the InferenceBatcher thread: batched WD14 inference
+      write   - write_workers threads: exiftool writes, verification, .txt check, then
+                marking as tagged in batches
+    Every queue is bounded, so a slow stage blocks the one before it and memory stays
+    flat however many images there are.
+    """
+    def __init__(self, decode_workers=DECODE_WORKERS, write_workers=WRITE_WORKERS, batch_size=WD14_BATCH_SIZE,
+                 batch_timeout=WD14_BATCH_TIMEOUT, queue_size=PIPELINE_QUEUE_SIZE):
+        self.decode_workers = decode_workers
+        self.write_workers = write_workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.queue_size = queue_size
+        self.stats = {
+            'decode': StageStats('decode', decode_workers),
+            'infer': StageStats('infer', 1),
+            'write': StageStats('write', write_workers),
+            'mark': StageStats('mark', write_workers),
+        }
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def _done(self, ok, pbar, skipped=False):
+        with self._lock:
+            if skipped:
+                self.skipped += 1
+            elif ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+        pbar.update(1)
+
+    def _decode(self, paths, batcher, write_queue, pbar):
+        while True:
+            image_path = paths.get()
+            if image_path is None:
+                return
+            start = time.perf_counter()
+            try:
+                prepared = prepare_file(image_path)
+                if prepared is True or prepared is False:
+                    # True is an image that needed nothing doing
+                    self.stats['decode'].add(time.perf_counter() - start, failed=int(not prepared), skipped=int(prepared))
+                    self._done(prepared, pbar, skipped=prepared)
+                    continue
+                image, snapshot = prepared
+                batcher.model.draft(image)
+                # Images whose pixels were inferred before skip preprocessing and the model
+                pixel_hash = inference_cache_key(image, snapshot.pixel_hash) if batcher.cache is not None else None
+                future = batcher.cached(pixel_hash)
+                if future is None:
+                    array = batcher.model.preprocess(image)
+                else:
+                    logger.info("ImagePipeline: " + image_path + " found in the inference cache")
+            except Exception as e:
+                logger.error("ImagePipeline decode FAILED for " + image_path + ". " + str(e))
+                self.stats['decode'].record(time.perf_counter() - start, False)
+                self._done(False, pbar)
+                continue
+            self.stats['decode'].record(time.perf_counter() - start)
+            if future is None:
+                future = batcher.submit(image_path, array, pixel_hash)
+            future.add_done_callback(lambda f, image_path=image_path, snapshot=snapshot:
+                                     self._inferred(image_path, snapshot, f, write_queue, pbar))
+
+    def _inferred(self, image_path, snapshot, future, write_queue, pbar):
+        # Runs on the batcher thread, so a full write queue holds up inference.  Cache hits
+        # are already done and run it on the decode thread.
+        if future.exception() is not None:
+            logger.error("Processfile tag extraction for " + image_path + " didn't work. FAILED  Skipping")
+            self._done(False, pbar)
+            return
+        gr_ratings, gr_output_text, gr_tags = future.result()
+        write_queue.put((image_path, gr_output_text, snapshot))
+
+    def _mark(self, to_mark, pbar):
+        start = time.perf_counter()
+        for image_path, ok in exiftool_mark_tagged_batch(to_mark):
+            if ok:
+                logger.info("Processfile " + " SUCCESS marking as processed " + image_path + ".")
+            else:
+                logger.error("Processfile " + " FAILED marking as processed " + image_path + ".")
+            self._done(ok, pbar)
+        self.stats['mark'].record(time.perf_counter() - start, items=len(to_mark))
+        to_mark.clear()
+
+    def _write(self, write_queue, pbar):
+        # Images are marked as processed MARK_BATCH_SIZE at a time, once their tags are written and checked
+        to_mark = []
+        while True:
+            item = write_queue.get()
+            if item is None:
+                if to_mark:
+                    self._mark(to_mark, pbar)
+                return
+            image_path, gr_output_text, snapshot = item
+            start = time.perf_counter()
+            try:
+                ok = finish_file(image_path, gr_output_text, snapshot, mark=False)
+            except Exception as e:
+                logger.error("ImagePipeline write FAILED for " + image_path + ". " + str(e))
+                ok = False
+            self.stats['write'].record(time.perf_counter() - start, ok)
+            if ok:
+                to_mark.append(image_path)
+                if len(to_mark) >= MARK_BATCH_SIZE:
+                    self._mark(to_mark, pbar)
+            else:
+                self._done(ok, pbar)
+
+    def run(self, image_paths, total=None):
+        paths = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        batcher = InferenceBatcher(batch_size=self.batch_size, timeout=self.batch_timeout,
+                                   max_pending=max(self.queue_size, 2 * self.batch_size), stats=self.stats['infer'],
+                                   cache=get_inference_cache())
+        start = time.perf_counter()
+
+        from tqdm import tqdm
+        with tqdm(total=total) as pbar:
+            decoders = [threading.Thread(target=self._decode, args=(paths, batcher, write_queue, pbar), name=f"decode-{i}")
+                        for i in range(self.decode_workers)]
+            writers = [threading.Thread(target=self._write, args=(write_queue, pbar), name=f"write-{i}")
+                       for i in range(self.write_workers)]
+            for thread in decoders + writers:
+                thread.start()
+
+            for image_path in image_paths:
+                paths.put(image_path)
+
+            # Drain the stages in order: no more decodes, flush the last batch, then no more writes
+            for thread in decoders:
+                paths.put(None)
+            for thread in decoders:
+                thread.join()
+            batcher.close()
+            for thread in writers:
+                write_queue.put(None)
+            for thread in writers:
+                thread.join()
+        et_pool.close_finished_threads()
+
+        elapsed = time.perf_counter() - start
+        for stage in self.stats.values():
+            logger.info("ImagePipeline " + stage.summary(elapsed))
+        if batcher.cache is not None:
+            logger.info("ImagePipeline " + batcher.cache.summary())
+        logger.info("ImagePipeline: " + str(self.succeeded) + " succeeded, " + str(self.failed) + " failed, "
+                    + str(self.skipped) + " skipped in " + f"{elapsed:.2f}" + " seconds")
+        return self.succeeded, self.failed
+
 def Add_a_Tag(image_path, tag):
     print("Attempting to add tags " + str(tag))
-    retval = exiftool_Update_tags(image_path, tag)
-    if find_duplicate_tags_in_file(image_path) :
+    snapshot = ExifSnapshot.read(image_path)
+    retval = exiftool_Update_tags(image_path, tag, snapshot)
+    # The update only adds missing tags, so duplicates are the ones already there
+    if find_duplicate_tags_in_file(image_path, snapshot) :
         logger.debug("Processfile " +  "There were duplicate tags in " + image_path)
         exiftool_del_dupetags(image_path)
 
 
-def process_images_in_directory(directory, tag=False,person=False,Hashimages=False):
-    # Process each image in the directory
+def iter_images(directory, sort=True, skip=None):
+    # Image paths under directory as the scan finds them.  sort orders each directory
+    # rather than the whole tree.  skip(record) is given the scanner.FileRecord (path,
+    # size, mtime, ...) and returns True for files to leave out without opening them.
+    skipped = 0
+    def onerror(e):
+        logger.error("iter_images: " + str(e))
+    for record in scanner.scan(directory, onerror=onerror, sort=sort):
+        if not record.path.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if skip is not None and skip(record):
+            skipped += 1
+            continue
+        yield record.path
+    logger.info("iter_images: finished scanning " + directory + ". " + str(skipped) + " images skipped as already done")
+
+def process_images_in_directory(directory, tag=False,person=False,Hashimages=False,batch_size=WD14_BATCH_SIZE,batch_timeout=WD14_BATCH_TIMEOUT,
+                                stream=True, sort=True, skip=None):
+    # Process each image in the directory.  With stream the work starts on the first
+    # image found instead of after listing and sorting the whole tree; sort then orders
+    # each directory, files the processing state has already done for the stage are
+    # left out, and so is anything skip(record) returns True for.
+    logger.info("Starting")
+    if stream:
+        logger.info("streaming file list from " + directory)
+        state = get_processing_state()
+
+        def image_source(done_outcomes=0):
+            def is_done(record):
+                if skip is not None and skip(record):
+                    return True
+                return state is not None and state.get(record.path, record) & done_outcomes != 0
+            return iter_images(directory, sort=sort, skip=is_done)
+
+        process_image_paths(image_source, None, tag, person, Hashimages, batch_size, batch_timeout)
+        return
+
     image_paths = []
     overall_processed_images = 0
-    logger.info("Starting")
 
     logger.info("fetching file list.  This could take a while.")
     for root, dirs, files in os.walk(directory):
@@ -729,42 +1648,58 @@ def process_images_in_directory(directory, tag=False,person=False,Hashimages=Fal
     processed_images = 0
     average_time_per_image = 0
 
-#    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        completed_count = 0
-        cnt = 1
-        # Submit the image processing tasks
-        for image_path in image_paths:
-            print(str(cnt) + "." + image_path)
-            cnt +=1
-            if tag == False and person == False and Hashimages == False:
-                print("Processing as normal")
-                future = executor.submit(process_file, image_path)
-                futures.append(future)
-            if person == True:
-                print("Add Folder as a person")
-                #parent_directory = os.path.dirname(image_path)
-                parent_directory = os.path.basename(os.path.dirname(image_path))
-                person2 =[]
-                person2.append("Person/" + parent_directory)
-                print("Add " + str(person2) + " to file " + image_path + " and process as adding parent folder as person tag")
-                future = executor.submit(Add_a_Tag, image_path, person2)
-                futures.append(future)                
-            if tag != False:
-                print("Adding a tag to a file")
-                future = executor.submit(Add_a_Tag, image_path, tag)
-                futures.append(future)
-            if Hashimages == True:
-                future = executor.submit(exiftool_hash, image_path)
-                futures.append(future)                
-
-    # Use tqdm to display progress bar
-        with tqdm(total=len(futures)) as pbar:
-            while completed_count < len(futures):
-                completed_count = sum(1 for future in futures if future.done())
-                pbar.update(completed_count - pbar.n)
-
+    process_image_paths(lambda done_outcomes=0: image_paths, num_images, tag, person, Hashimages, batch_size, batch_timeout)
+
+def process_image_paths(image_source, num_images, tag=False,person=False,Hashimages=False,batch_size=WD14_BATCH_SIZE,batch_timeout=WD14_BATCH_TIMEOUT):
+    # image_source(done_outcomes) returns the image paths, a list or a generator, and may
+    # leave out files that already have any of the processingstate done_outcomes.  It's
+    # called once per stage.  num_images is None when the number isn't known up front.
+    if tag == False and person == False and Hashimages == False:
+        print("Processing as normal")
+        pipeline = ImagePipeline(batch_size=batch_size, batch_timeout=batch_timeout)
+        pipeline.run(image_source(processingstate.TAGGED | processingstate.BAD_FILE), total=num_images)
+        logger.info("finished")
+        return
+
+    def tags_for(image_path):
+        tags = []
+        if person == True:
+            #parent_directory = os.path.dirname(image_path)
+            parent_directory = os.path.basename(os.path.dirname(image_path))
+            tags.append("Person/" + parent_directory)
+        if tag != False:
+            tags += tag
+        return tags
+
+    def tag_chunk(chunk):
+        results = tag_files(chunk, tags_for)
+        if person == True:
+            for image_path, outcome in results.items():
+                if outcome != 'failed':
+                    record_outcome(image_path, processingstate.PERSON_TAGGED)
+        return results
+
+    def tag_tasks():
+        # Person and tag writes go to exiftool EXIFTOOL_BATCH_SIZE files at a time, as one
+        # write per file would be mostly exiftool overhead.  Both kinds of tag go in the
+        # same write so two threads never write the same file.  Only person tags are
+        # recorded in the processing state; tags given on the command line change from
+        # run to run.
+        done_outcomes = processingstate.PERSON_TAGGED | processingstate.BAD_FILE if tag == False else 0
+        image_paths = iter(image_source(done_outcomes))
+        while True:
+            chunk = list(itertools.islice(image_paths, EXIFTOOL_BATCH_SIZE))
+            if not chunk:
+                return
+            yield 'tag', len(chunk), tag_chunk, (chunk,)
+
+    # One stage after the other, so a file's tag write and hash write never overlap
+    if person == True or tag != False:
+        print("Adding tags in batches of " + str(EXIFTOOL_BATCH_SIZE) + " files")
+        run_tasks(tag_tasks(), ['tag'], total=num_images)
+    if Hashimages == True:
+        print("Hashing in " + str(HASH_WORKERS) + " processes, writing in batches of " + str(EXIFTOOL_BATCH_SIZE) + " files")
+        hash_files(image_source(processingstate.HASHED | processingstate.BAD_FILE), total=num_images)
 
     logger.info("finished")
 
@@ -781,6 +1716,52 @@ def process_images_in_directory(directory, tag=False,person=False,Hashimages=Fal
         
         #for future in concurrent.futures.:
 
+def _rebuild_state_chunk(records):
+    state = get_processing_state()
+    snapshots = exiftool_read_snapshots([record.path for record in records])
+    # prepare_file moves files it can't open to badfiles/ under the working directory
+    bad_files_folder = os.path.join(os.path.abspath('badfiles'), '')
+    results = {}
+    for record in records:
+        snapshot = snapshots.get(record.path)
+        outcomes = processingstate.BAD_FILE if os.path.abspath(record.path).startswith(bad_files_folder) else 0
+        if snapshot is None:
+            if outcomes:
+                state.set(record.path, record, outcomes)
+                results[record.path] = 'succeeded'
+            else:
+                state.forget(record.path)
+                results[record.path] = 'failed'
+            continue
+        if snapshot.tagged:
+            outcomes |= processingstate.TAGGED
+        if snapshot.pixel_hash:
+            outcomes |= processingstate.HASHED
+        if "Person/" + os.path.basename(os.path.dirname(record.path)) in snapshot.tags['XMP:Subject']:
+            outcomes |= processingstate.PERSON_TAGGED
+        state.set(record.path, record, outcomes)
+        results[record.path] = 'succeeded'
+    return results
+
+def rebuild_processing_state(directory):
+    # Reconcile the processing state with what the files' own XMP says: tagged marker,
+    # pixel hash and person tag, plus bad-file for files in badfiles/.  Replaces what was recorded for every image under
+    # directory, e.g. after files were edited by other tools or the database was lost.
+    if get_processing_state() is None:
+        logger.error("rebuild_processing_state: PROCESSING_STATE_DB is off")
+        return
+    records = (record for record in scanner.scan(directory, sort=True) if record.path.lower().endswith(IMAGE_EXTENSIONS))
+
+    def tasks():
+        while True:
+            chunk = list(itertools.islice(records, EXIFTOOL_BATCH_SIZE))
+            if not chunk:
+                return
+            yield 'rebuild', len(chunk), _rebuild_state_chunk, (chunk,)
+
+    run_tasks(tasks(), ['rebuild'])
+    logger.info("rebuild_processing_state: " + directory + ". Files per outcome: " + str(get_processing_state().counts()))
+
 # Specify the directory containing the images
 
 # Process the images in the directory and generate captions
@@ -805,13 +1786,11 @@ def execute_script(directory=None, tag=None, person=False,hashimage=False):
         personopt = True
     else:
         personopt = False
+    hashimageopt = False
     
     if hashimage == 'True':
         print("hashimage set to true")
         hashimageopt = True
-    
-
-    hashimageopt = True
 
     # Change the current working directory to the specified directory
     #os.chdir(directory)
@@ -820,6 +1799,9 @@ def execute_script(directory=None, tag=None, person=False,hashimage=False):
     # For demonstration purposes, let's print the current working directory
     #logger.info("Current working directory:", os.getcwd())
     process_images_in_directory(directory, taglist,personopt,hashimageopt)
+    et_pool.close_all()
+    close_inference_cache()
+    close_processing_state()
     logger.info("Processing complete!")
 
 def execute_single(file, tag=None):
@@ -830,11 +1812,23 @@ def execute_single(file, tag=None):
         print("tag provided:" + str(tag))
         taglist = tag.split(",")
         Add_a_Tag(file,taglist)
+    et_pool.close_all()
+    close_inference_cache()
+    close_processing_state()
+    logger.info("Processing complete!")
+
+def execute_rebuild_state(directory):
+    rebuild_processing_state(directory)
+    et_pool.close_all()
+    close_processing_state()
     logger.info("Processing complete!")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 2 and sys.argv[1] == '--rebuild-state':
+        # combo.py --rebuild-state <directory>
+        execute_rebuild_state(os.path.abspath(sys.argv[2]))
+    elif len(sys.argv) > 1:
         print("Opts on command line " + str(len(sys.argv)))
         # Use the path provided as a command line argument
         print("path command line " + str(sys.argv[1]))
@@ -1,9 +1,11 @@
 import os
 import csv
-import hashlib
-import time
 
-HASH_CHUNK_SIZE_MB = 64  # Chunk size in MB for hashing
+import hashcore
+from hashcache import open_cache
+from hashindex import HashIndex
+from progress import ProgressReporter
+from scanner import ScanState, scan
 
 def write_unique_hashes_to_csv(unique_hashes,outputfile):
     # Create a CSV file to write unique hashes and filepaths
@@ -23,131 +25,101 @@ def write_unique_hashes_to_csv(unique_hashes,outputfile):
 dir1 = "W:\\External_6TB_1\\root\\Videos"
 dir2 = "W:\\mergerfs\\data\Video2\\"
 
-# Filepath for cache.csv
+# Filepath for the hash cache.  cache.csv is the old format and is imported on first run.
+cache_db = 'cache.db'
 cache_file = 'cache.csv'
 #cache_file = 'W:\RAID5\dev-disk-by-uuid-342ac512-ae09-47a7-842f-d3158537d395\mnt\cache.csv'
 unique_file = 'unique.csv'
 duplicate_file = 'duplicate_hashes.csv'
 
+# Progress output: seconds between progress lines, quiet to print nothing, and an
+# optional file that gets the same numbers as JSON lines
+progress_interval = 5
+quiet = False
+metrics_file = None  # e.g. 'metrics.jsonl'
+
+# Optional database of directory mtimes.  Directories unchanged since the last run are
+# not listed again; note a file rewritten in place does not change its directory's mtime.
+scan_state_db = None  # e.g. 'scan_state.db'
+
 # Dictionary to store filepaths to be processed
 toprocess = {}
 
-# Read cache.csv into filehashes dictionary if it exists
-filehashes = {}
-if os.path.exists(cache_file):
-    print("Loading cache")
-    with open(cache_file, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            filehashes[row[0]] = row[1]
-    print("cache load complete")
-
-# Function to calculate the blake2 hash of a file
-def calculate_hash(file_path):
+print("Opening cache")
+cache = open_cache(cache_db, cache_file)
 
-    chunk_size = HASH_CHUNK_SIZE_MB * 1024 * 1024  # Convert to bytes
-    
-    file_size = os.path.getsize(file_path)
-    file_size_MB = file_size / (1024 * 1024)
-    start_time = time.time()
-    print(f"Creating hash for file: {file_path}")
-    hasher = hashlib.blake2b()
-    read_speed = 0.0 # Initialize read speed to 0 bytes/second
-    processed_bytes = 0 # Initialize processed bytes to 0
-    with open(file_path, 'rb') as file:
-        while True:
-            chunk = file.read(chunk_size)
-            if not chunk:
-                break
-            hasher.update(chunk)
-
-
-            processed_bytes += len(chunk)
-            elapsed_time = time.time() - start_time # Elapsed time since start
-            if elapsed_time > 0:
-                    # Update read speed based on processed bytes and elapsed time
-                    read_speed = (processed_bytes / elapsed_time) / (1024 * 1024)
-            percentage_processed = (processed_bytes / file_size) * 100
-            processed_bytes_MB = processed_bytes / (1024 * 1024)
-                # Print read speed for each chunk
-            #print(f'Read speed: {read_speed:.2f} bytes/second')
-            print(f'Percentage processed: {percentage_processed:.2f}%.  Read speed: {read_speed:.2f} MBps.  Size: {file_size_MB:.2f} MB.  Processed: {processed_bytes_MB} MB')
-            
-        end_time = time.time() # End time
-        processing_time = end_time - start_time # Calculate processing time
-        
-        # Print final read speed and processing time
-        print(f'Read speed: {read_speed:.2f} bytes/second.  Processing time: {processing_time:.2f} seconds')
-        print(f'hash: {hasher.hexdigest()}')
-
-    return hasher.hexdigest()
+# Function to calculate the blake2 hash of a file.  Progress is reported by the caller,
+# once per file, so the read loop does nothing but read and hash.
+def calculate_hash(file_path):
+    return hashcore.hash_file(file_path)
 
 # Function to process files in a directory recursively
-def process_directory(directory):
+def process_directory(directory, state=None):
     i = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            i += 1
-            filepath = os.path.join(dirpath, filename)
-            toprocess[filepath] = True
+    for record in scan(directory, state, onerror=lambda e: print("Unable to read " + str(e))):
+        i += 1
+        toprocess[record.path] = record
     print(str(directory) + " has " + str(i) + " files.")
 
 # Process both directories
 print("Loading files")
-process_directory(dir1)
-process_directory(dir2)
+state = ScanState(scan_state_db) if scan_state_db else None
+process_directory(dir1, state)
+process_directory(dir2, state)
+if state is not None:
+    state.close()
 
-# Remove filepaths from filehashes that are not in toprocess
-print("Removing " + str(len(filehashes)) + " known hashes.")
-filehashes = {k: v for k, v in filehashes.items() if k in toprocess}
-print("Known hashes removed. "  + str(len(toprocess)) + " to do.")
+# Load cached hashes for files that are still present and unchanged
+filehashes = {}
+for filepath, stat_result in toprocess.items():
+    file_hash = cache.get(filepath, stat_result)
+    if file_hash is not None:
+        filehashes[filepath] = file_hash
+print("Loaded " + str(len(filehashes)) + " known hashes. "  + str(len(toprocess)) + " to do.")
 
-# Initialize dictionaries to store unique and duplicate hashes
+# Initialize dictionary to store unique hashes, and the hash -> paths index used to find duplicates
 unique_hashes = {}
-duplicate_hashes = {}
+hashindex = HashIndex(filehashes)
 
 filetodo = sorted(toprocess.keys(), key=lambda x: (os.path.basename(x), x), reverse=True)
 # Process files in toprocess in filename order, with multiples of the same filename processed first
-i = 0
+newbytes = sum(toprocess[filepath].st_size for filepath in filetodo if filepath not in filehashes)
+progress = ProgressReporter(total_files=len(filetodo), total_bytes=newbytes, interval=progress_interval, quiet=quiet, metrics_file=metrics_file)
 for filepath in filetodo:
-    i +=1
-    print(str(i) + " of " + str(len(filetodo)))
     if filepath not in filehashes:
         # Calculate hash for new file
-        file_hash = calculate_hash(filepath)
-        # Check if hash exists in filehashes
-        with open(cache_file, 'w') as csvfile:
-            writer = csv.writer(csvfile)
-            for k, v in filehashes.items():
-                writer.writerow([k, v])
-
-        if file_hash in filehashes.values():
-            # Find all filepaths with the same hash
-            duplicate_files = [k for k, v in filehashes.items() if v == file_hash]
+        try:
+            file_hash = calculate_hash(filepath)
+        except OSError as e:
+            print("Unable to hash " + filepath + ". " + str(e))
+            progress.file_failed()
+            continue
+        stat_result = toprocess[filepath]
+        progress.file_done(stat_result.st_size, stat_result.st_dev)
+        cache.put(filepath, stat_result, file_hash)
+        filehashes[filepath] = file_hash
+
+        # Check if other files already have this hash
+        duplicate_files = hashindex.add(filepath, file_hash)
+        if len(duplicate_files) > 1:
             # Print hash and filepaths
             print(f"Duplicate hash: {file_hash}")
             print("Filepaths:")
             for file in duplicate_files:
                 print(file)
-            # Add hash and filepath to duplicate_hashes dictionary
-            duplicate_hashes[file_hash] = duplicate_files
-            filehashes[filepath] = file_hash
-            with open(duplicate_file, 'w') as csvfile:
-                writer = csv.writer(csvfile)
-                for k, v in duplicate_hashes.items():
-                    writer.writerow([k, ', '.join(v)])
-        else:
-            # Add hash and filepath to filehashes dictionary
-            filehashes[filepath] = file_hash
+            hashindex.write_duplicates_csv(duplicate_file)
     else:
-        print(filepath + " already hashed.  Load hash")
         # Get hash for existing file
         file_hash = filehashes[filepath]
+        progress.file_skipped()
     # Add hash and filepath to unique_hashes dictionary
     unique_hashes[file_hash] = filepath
-    # Write hash and filepath to cache.csv
 
-write_unique_filehashes_to_csv(filehashes,'comp-unique.csv')
+progress.close()
+cache.close()
+hashindex.write_duplicates_csv(duplicate_file, force=True)
+
+write_unique_hashes_to_csv(unique_hashes,'comp-unique.csv')
 
 with open(unique_file, 'w') as csvfile:
     writer = csv.writer(csvfile)
@@ -1,29 +1,23 @@
 import os
 import csv
 import hashlib
-import time
 
-HASH_CHUNK_SIZE_MB = 64  # Chunk size in MB for hashing
+import hashcore
+from hashcache import open_cache
+from hashindex import HashIndex
+from parallelhash import ParallelHasher
+from progress import ProgressReporter
+from scanner import ScanState, scan
 
-def write_unique_hashes_to_csv(filehashes, output_file):
-    # Create a dictionary to store unique file hashes
-    unique_filehashes = {}
+PARTIAL_HASH_MB = 4  # MB hashed from each end of a file before committing to a full hash
 
-    # Iterate through the dictionary and add unique file hashes to the dictionary
-    file_hash_list = list(filehashes.values())
-
-        # Iterate through the input filehashes dictionary
-    for filepath, file_hash in filehashes.items():
-        # If the filehash appears for the first time, add it to unique_filehashes
-        if file_hash_list.count(file_hash) == 1:
-            unique_filehashes[filepath] = file_hash
-
-    if len(unique_hashes) > 0:
+def write_unique_hashes_to_csv(unique_filehashes, output_file):
+    if len(unique_filehashes) > 0:
     # Write unique file hashes and their corresponding file paths to the CSV file
         with open(output_file, 'w') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(['File path', 'File hash'])
-            for file_hash, file_path in unique_filehashes.items():
+            for file_path, file_hash in unique_filehashes.items():
                 writer.writerow([file_path, file_hash])
         print(f"Successfully created CSV file with unique file hashes: {output_file}")
     else:
@@ -40,133 +34,182 @@ dir2 = "/srv/mergerfs/data/Videos/"
 #dir1 = "W:\\External_6TB_1\\root\\Videos"
 #dir2 = "W:\\mergerfs\\data\Video2\\"
 
-# Filepath for cache.csv
+# Filepath for the hash cache.  cache.csv is the old format and is imported on first run.
+cache_db = 'cache.db'
 cache_file = 'cache.csv'
 #cache_file = 'W:\RAID5\dev-disk-by-uuid-342ac512-ae09-47a7-842f-d3158537d395\mnt\cache.csv'
 unique_file = 'unique.csv'
 duplicate_file = 'duplicate_hashes.csv'
+# Hashing workers per device, keyed by os.stat().st_dev.  Devices not listed are detected
+# from /sys: one reader for spinning disks, several for SSDs.
+workers_per_device = {}
+
+# Optional database of directory mtimes.  Directories unchanged since the last run are
+# not listed again; note a file rewritten in place does not change its directory's mtime.
+scan_state_db = None  # e.g. 'scan_state.db'
+
+# Progress output: seconds between progress lines, quiet to print nothing, and an
+# optional file that gets the same numbers as JSON lines
+progress_interval = 5
+quiet = False
+metrics_file = None  # e.g. 'metrics.jsonl'
+
+# Function to calculate the blake2 hash of the first and last PARTIAL_HASH_MB of a file
+def calculate_partial_hash(file_path, file_size):
+
+    partial_size = PARTIAL_HASH_MB * 1024 * 1024  # Convert to bytes
 
-# Dictionary to store filepaths to be processed
-toprocess = {}
-
-# Read cache.csv into filehashes dictionary if it exists
-filehashes = {}
-if os.path.exists(cache_file):
-    print("Loading cache")
-    with open(cache_file, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            filehashes[row[0]] = row[1]
-    print("cache load complete")
-
-# Function to calculate the blake2 hash of a file
-def calculate_hash(file_path):
-
-    chunk_size = HASH_CHUNK_SIZE_MB * 1024 * 1024  # Convert to bytes
-    
-    file_size = os.path.getsize(file_path)
-    file_size_MB = file_size / (1024 * 1024)
-    start_time = time.time()
-    print(f"Creating hash for file: {file_path}")
     hasher = hashlib.blake2b()
-    read_speed = 0.0 # Initialize read speed to 0 bytes/second
-    processed_bytes = 0 # Initialize processed bytes to 0
+    view = hashcore.get_buffer(partial_size)
     with open(file_path, 'rb') as file:
-        while True:
-            chunk = file.read(chunk_size)
-            if not chunk:
-                break
-            hasher.update(chunk)
-
-
-            processed_bytes += len(chunk)
-            elapsed_time = time.time() - start_time # Elapsed time since start
-            if elapsed_time > 0:
-                    # Update read speed based on processed bytes and elapsed time
-                    read_speed = (processed_bytes / elapsed_time) / (1024 * 1024)
-            percentage_processed = (processed_bytes / file_size) * 100
-            processed_bytes_MB = processed_bytes / (1024 * 1024)
-                # Print read speed for each chunk
-            #print(f'Read speed: {read_speed:.2f} bytes/second')
-            print(f'Percentage processed: {percentage_processed:.2f}%.  Read speed: {read_speed:.2f} MBps.  Size: {file_size_MB:.2f} MB.  Processed: {processed_bytes_MB} MB')
-            
-        end_time = time.time() # End time
-        processing_time = end_time - start_time # Calculate processing time
-        
-        # Print final read speed and processing time
-        print(f'Read speed: {read_speed:.2f} bytes/second.  Processing time: {processing_time:.2f} seconds')
-        print(f'hash: {hasher.hexdigest()}')
+        n = file.readinto(view)
+        hasher.update(view[:n])
+        if file_size > partial_size:
+            file.seek(max(partial_size, file_size - partial_size))
+            n = file.readinto(view)
+            hasher.update(view[:n])
 
     return hasher.hexdigest()
 
+# Number of bytes calculate_partial_hash reads for a file of this size
+def partial_hash_bytes(file_size):
+    return min(file_size, 2 * PARTIAL_HASH_MB * 1024 * 1024)
+
 # Function to process files in a directory recursively
-def process_directory(directory):
+def process_directory(directory, toprocess, state=None):
     i = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            i += 1
-            filepath = os.path.join(dirpath, filename)
-            toprocess[filepath] = True
+    for record in scan(directory, state, onerror=lambda e: print("Unable to read " + str(e))):
+        i += 1
+        toprocess[record.path] = record
     print(str(directory) + " has " + str(i) + " files.")
 
-# Process both directories
-print("Loading files")
-process_directory(dir1)
-process_directory(dir2)
-
-# Remove filepaths from filehashes that are not in toprocess
-print("We know " + str(len(filehashes)) + " known hashes.")
-filehashes = {k: v for k, v in filehashes.items() if k in toprocess}
-print("There are hashes left to process. "  + str(len(toprocess)) + " to do.")
-
-#if len(filehashes) == 0:
-#    print("filehashes is empty")
-#    exit()
-
-# Initialize dictionaries to store unique and duplicate hashes
-unique_hashes = {}
-duplicate_hashes = {}
-
-filetodo = sorted(toprocess.keys(), key=lambda x: (os.path.basename(x), x), reverse=True)
-# Process files in toprocess in filename order, with multiples of the same filename processed first
-i = 0
-for filepath in filetodo:
-    i +=1
-    print(str(i) + " of " + str(len(filetodo)))
-    if filepath not in filehashes:
-        # Calculate hash for new file
-        file_hash = calculate_hash(filepath)
-        filehashes[filepath] = file_hash
-
-        # Check if hash exists in filehashes
-        with open(cache_file, 'w') as csvfile:
-            writer = csv.writer(csvfile)
-            for k, v in filehashes.items():
-                writer.writerow([k, v])
-
-        if file_hash in filehashes.values():
-            # Find all filepaths with the same hash
-            duplicate_files = [k for k, v in filehashes.items() if v == file_hash]
-            # Print hash and filepaths
-            print(f"Duplicate hash: {file_hash}")
-            print("Filepaths:")
-            for file in duplicate_files:
-                print(file)
-            # Add hash and filepath to duplicate_hashes dictionary
-            duplicate_hashes[file_hash] = duplicate_files
+def add_to_index(hashindex, filepath, file_hash):
+    duplicate_files = hashindex.add(filepath, file_hash)
+    if len(duplicate_files) > 1:
+        # Print hash and filepaths
+        print(f"Duplicate hash: {file_hash}")
+        print("Filepaths:")
+        for file in duplicate_files:
+            print(file)
+        hashindex.write_duplicates_csv(duplicate_file)
+
+def main():
+    # Dictionary to store filepaths to be processed
+    toprocess = {}
+
+    print("Opening cache")
+    cache = open_cache(cache_db, cache_file)
+
+    # Process both directories
+    print("Loading files")
+    state = ScanState(scan_state_db) if scan_state_db else None
+    process_directory(dir1, toprocess, state)
+    process_directory(dir2, toprocess, state)
+    if state is not None:
+        state.close()
+
+    # Load cached hashes for files that are still present and unchanged
+    filehashes = {}
+    for filepath, stat_result in toprocess.items():
+        file_hash = cache.get(filepath, stat_result)
+        if file_hash is not None:
             filehashes[filepath] = file_hash
-            with open(duplicate_file, 'w') as csvfile:
-                writer = csv.writer(csvfile)
-                for k, v in duplicate_hashes.items():
-                    writer.writerow([k, ', '.join(v)])
+    print("We know " + str(len(filehashes)) + " known hashes.")
+    print("There are hashes left to process. "  + str(len(toprocess)) + " to do.")
+
+    #if len(filehashes) == 0:
+    #    print("filehashes is empty")
+    #    exit()
+
+    # Bytes we did not have to read, per stage
+    saved_bytes = {'size': 0, 'partial': 0}
+
+    # Stage 1: group by size.  A file with a size nobody else has cannot be a duplicate.
+    size_groups = {}
+    for filepath, stat_result in toprocess.items():
+        size_groups.setdefault(stat_result.st_size, []).append(filepath)
+
+    candidates = []
+    for file_size, filepaths in size_groups.items():
+        if len(filepaths) > 1:
+            candidates.append((file_size, filepaths))
         else:
-            # Add hash and filepath to filehashes dictionary
-            filehashes[filepath] = file_hash
-    else:
-        print(filepath + " already hashed.  Load hash")
-        # Get hash for existing file
-        file_hash = filehashes[filepath]
+            if filepaths[0] not in filehashes:
+                saved_bytes['size'] += file_size
+    print(str(sum(len(f) for s, f in candidates)) + " files share a size with another file.")
+
+    # Stage 2: group same size files by a hash of their first and last few MB.
+    # Groups where every file is already in the cache, or files small enough that the
+    # partial hash would read the whole file anyway, go straight to the full hash stage.
+    tohash = []
+    failed = set()  # Files that couldn't be read, neither unique nor duplicate
+    i = 0
+    for file_size, filepaths in candidates:
+        i += 1
+        if all(filepath in filehashes for filepath in filepaths) or partial_hash_bytes(file_size) >= file_size:
+            tohash.extend(filepaths)
+            continue
+        print(str(i) + " of " + str(len(candidates)) + " size groups. Partial hashing " + str(len(filepaths)) + " files of " + str(file_size) + " bytes")
+        partial_groups = {}
+        for filepath in filepaths:
+            try:
+                partial_hash = calculate_partial_hash(filepath, file_size)
+            except OSError as e:
+                print("Unable to read " + filepath + ". " + str(e))
+                failed.add(filepath)
+                continue
+            partial_groups.setdefault(partial_hash, []).append(filepath)
+        for partial_hash, same_partial in partial_groups.items():
+            if len(same_partial) > 1:
+                tohash.extend(same_partial)
+            else:
+                if same_partial[0] not in filehashes:
+                    saved_bytes['partial'] += file_size - partial_hash_bytes(file_size)
+
+    # Stage 3: full hash of the files that still collide, indexed by hash to find the duplicates
+    hashindex = HashIndex()
+
+    filetodo = sorted(tohash, key=lambda x: (os.path.basename(x), x), reverse=True)
+    # Known hashes go straight into the index, the rest are hashed in parallel across devices.
+    # Files are started in filename order, with multiples of the same filename processed first.
+    newfiles = [(filepath, toprocess[filepath]) for filepath in filetodo if filepath not in filehashes]
+    progress = ProgressReporter(total_files=len(filetodo), total_bytes=sum(st.st_size for f, st in newfiles),
+                                interval=progress_interval, quiet=quiet, metrics_file=metrics_file)
+    for filepath in filetodo:
+        if filepath in filehashes:
+            add_to_index(hashindex, filepath, filehashes[filepath])
+            progress.file_skipped()
+
+    for filepath, file_hash, error in ParallelHasher(workers_per_device).hash_files(newfiles):
+        if error is not None:
+            print("Unable to hash " + filepath + ". " + str(error))
+            progress.file_failed()
+            failed.add(filepath)
+            continue
+        stat_result = toprocess[filepath]
+        progress.file_done(stat_result.st_size, stat_result.st_dev)
+        filehashes[filepath] = file_hash
+        cache.put(filepath, stat_result, file_hash)
+        add_to_index(hashindex, filepath, file_hash)
+
+    progress.close()
+    cache.close()
+    hashindex.write_duplicates_csv(duplicate_file, force=True)
+
+    # Everything not in a duplicate group is unique.  Files ruled out by size or partial hash
+    # were never fully hashed, so they only have a hash if the cache already held one.
+    # Files that couldn't be read are left out, they may well be duplicates.
+    duplicate_paths = {filepath for v in hashindex.duplicates().values() for filepath in v}
+    unique_filehashes = {filepath: filehashes.get(filepath, '') for filepath in toprocess
+                         if filepath not in duplicate_paths and filepath not in failed}
+    if failed:
+        print(str(len(failed)) + " files could not be read and are in neither the duplicate nor the unique list")
+
+    print(f"Size stage saved reading {saved_bytes['size'] / (1024 * 1024):.2f} MB")
+    print(f"Partial hash stage saved reading {saved_bytes['partial'] / (1024 * 1024):.2f} MB")
 
+    write_unique_hashes_to_csv(unique_filehashes,'comp-unique.csv')
 
-write_unique_hashes_to_csv(filehashes,'comp-unique.csv')
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import atexit
+import logging
+import threading
+
+import exiftool
+from exiftool.exceptions import ExifToolException
+
+# Long lived exiftool processes shared by combo.py's metadata helpers.
+#
+# Each thread gets its own ExifToolHelper, started once in -stay_open mode and reused
+# for every call that thread makes, so a metadata read or write is a round trip over
+# the pipe rather than starting Perl.  A process that has died is replaced before the
+# next call, a call that fails because the process went away is retried once on a
+# fresh one, and every process is terminated on close_all() or at exit.  Worker
+# threads come and go with each stage's thread pool, so the processes of threads that
+# have exited are terminated by close_finished_threads(), and whenever a new one starts.
+
+logger = logging.getLogger('my_logger')
+
+COMMON_ARGS = ["-G", "-n"]
+
+
+class ExifToolPool:
+    def __init__(self, common_args=COMMON_ARGS):
+        self.common_args = common_args
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances = []
+        self._owners = {}  # exiftool -> the thread it was started for
+        self.started = 0
+        self.restarts = 0
+
+    def _start(self):
+        self.close_finished_threads()
+        et = exiftool.ExifToolHelper(common_args=self.common_args, auto_start=False)
+        et.run()
+        with self._lock:
+            self._instances.append(et)
+            self._owners[et] = threading.current_thread()
+            self.started += 1
+        self._local.et = et
+        logger.debug("ExifToolPool: started exiftool for thread " + threading.current_thread().name)
+        return et
+
+    def _discard(self, et):
+        with self._lock:
+            if et in self._instances:
+                self._instances.remove(et)
+            self._owners.pop(et, None)
+        try:
+            et.terminate()
+        except Exception:
+            pass
+        self._local.et = None
+
+    def get(self):
+        """Return this thread's running exiftool, starting or restarting it if needed."""
+        et = getattr(self._local, 'et', None)
+        if et is not None and et.running:
+            return et
+        # Not in _instances means close_all() stopped it, not a crash
+        if et is not None and et in self._instances:
+            logger.warning("ExifToolPool: exiftool for thread " + threading.current_thread().name + " died. Restarting")
+            self._discard(et)
+            with self._lock:
+                self.restarts += 1
+        return self._start()
+
+    def _call(self, method, *args, **kwargs):
+        et = self.get()
+        try:
+            return getattr(et, method)(*args, **kwargs)
+        except (OSError, ExifToolException):
+            # ExifToolExecuteError is exiftool reporting a problem with the file, and a
+            # live process means the error came from exiftool, not the pipe
+            if et.running:
+                raise
+            logger.warning("ExifToolPool: exiftool died during " + method + ". Retrying on a new process")
+            self._discard(et)
+            with self._lock:
+                self.restarts += 1
+            return getattr(self._start(), method)(*args, **kwargs)
+
+    def execute(self, *params):
+        return self._call('execute', *params)
+
+    def get_tags(self, files, tags, params=None):
+        return self._call('get_tags', files, tags, params=params)
+
+    def set_tags(self, files, tags, params=None):
+        return self._call('set_tags', files, tags, params=params)
+
+    def close_finished_threads(self):
+        """Terminate the exiftool processes of threads that have exited."""
+        with self._lock:
+            finished = [et for et in self._instances if not self._owners[et].is_alive()]
+            for et in finished:
+                self._instances.remove(et)
+                del self._owners[et]
+        for et in finished:
+            try:
+                et.terminate()
+            except Exception:
+                pass
+        if finished:
+            logger.debug("ExifToolPool: stopped " + str(len(finished)) + " exiftool processes of finished threads")
+
+    def close_all(self):
+        with self._lock:
+            instances = self._instances
+            self._instances = []
+            self._owners = {}
+        for et in instances:
+            try:
+                et.terminate()
+            except Exception:
+                pass
+        if instances:
+            logger.info("ExifToolPool: stopped " + str(len(instances)) + " exiftool processes. "
+                        + str(self.started) + " started, " + str(self.restarts) + " restarts")
+
+
+pool = ExifToolPool()
+atexit.register(pool.close_all)
@@ -1,12 +1,16 @@
 import os
-import hashlib
 import re
 import csv
 import signal
 import sys
 
+from hashcache import open_cache
+from hashindex import HashIndex
+from scanner import ScanState, scan
+
 #import concurrent.futures
-from pydub import AudioSegment
+
+from audioanalysis import analyse_audio, print_audio_info
 
 def signal_handler(sig, frame):
     print("Ctrl+C received. Exiting gracefully...")
@@ -16,54 +20,6 @@ def signal_handler(sig, frame):
 # Register the signal handler for Ctrl+C
 signal.signal(signal.SIGINT, signal_handler)
 
-# Example struct-like class to store audio file information
-class AudioFileInfo:
-    def __init__(self, title, artist, album, genre, bitrate, sample_rate, channels, duration, frame_count, format):
-        self.title = title
-        self.artist = artist
-        self.album = album
-        self.genre = genre
-        self.bitrate = bitrate
-        self.sample_rate = sample_rate
-        self.channels = channels
-        self.duration = duration
-        self.frame_count = frame_count
-        self.format = format
-
-def get_audio_data(filepath):
-    # Load audio file using pydub
-    audio_file = AudioSegment.from_file(filepath)
-
-    try:
-        # Extract information from audio file
-        title = audio_file.tags.get("title")
-        artist = audio_file.tags.get("artist")
-        album = audio_file.tags.get("album")
-        genre = audio_file.tags.get("genre")
-        bitrate = audio_file.frame_rate
-        sample_rate = audio_file.frame_rate
-        channels = audio_file.channels
-        duration = audio_file.duration_seconds
-        frame_count = audio_file.frame_count()
-        format = audio_file.format
-
-        # Create AudioFileInfo object to store extracted information
-        audio_info = AudioFileInfo(title, artist, album, genre, bitrate, sample_rate, channels, duration, frame_count, format)
-
-        # Access extracted information from AudioFileInfo object
-        print("Title:", audio_info.title)
-        print("Artist:", audio_info.artist)
-        print("Album:", audio_info.album)
-        print("Genre:", audio_info.genre)
-        print("Bitrate:", audio_info.bitrate)
-        print("Sample Rate:", audio_info.sample_rate)
-        print("Channels:", audio_info.channels)
-        print("Duration:", audio_info.duration, "seconds")
-        print("Frame Count:", audio_info.frame_count)
-        print("Format:", audio_info.format)
-    except:
-        return None
-
 def atoi(text):
     return int(text) if text.isdigit() else text
 
@@ -101,67 +57,22 @@ def move_file(src_path, dst_path):
     os.rename(src_path, dst_file_path)
     print("file " + src_path + " moved to " + dst_file_path)
 
-def createhash(filetohash):
-    print("Hashing " + filetohash)
-    try:
-        audio = AudioSegment.from_file(filetohash)
-        hash = hashlib.blake2b(audio.raw_data, digest_size=16).hexdigest()
-        print(hash + " is hash for " + filetohash)
-        return hash
-    except:
-        print("badfile")
-        return None
-
-
-def main():
-    # num_threads = int(input("Enter the number of threads to use: "))
-    file_hashes = {}
-    print("starting")
-    audio_extensions = ['.mp3', '.wav', '.ogg', '.flac']
-    pydub_supported_formats = ['.mp3', '.wav', '.aiff', '.flac', '.m4a', '.ogg', '.aac', '.ac3', '.wma']
-
-    for root, dirs, files in os.walk(directory):
-        #dirs.sort(key=natural_keys)
-        for dir in sorted(dirs):
-                dir_path = os.path.join(root, dir)
-                print("Processing directory: " + root)
-                for file in os.listdir(dir_path):
-                    #print("Processing " + file)
-                    if file.endswith(tuple(pydub_supported_formats)):
-                        file_path = os.path.join(dir_path, file)
-                        print(file_path + " Supported file type")
-
-                        get_audio_data(file_path)
-                        audio = AudioSegment.from_file(file_path)
-                        audiohash =  hashlib.blake2b(audio.raw_data, digest_size=16).hexdigest()
-                        # Dictionary to store file hashes and their paths
-                        with open(f'allHashes.txt', 'a') as f1:
-                            f1.write(file_path + ","  "," + audiohash + "\n")
-                        print(file_path + " hash is " + audiohash)
-                        if audiohash in file_hashes:
-                            print(file_path + " IS a duplicate !!!!!")
-                            dupe = file_hashes[audiohash]
-                            with open(f'allHashes.txt', 'a') as f1, open(f'duplicates.txt', 'a') as f2:
-                                f2.write(file_path + "," + dupe + "," + audiohash + "\n")
-                            move_file(file_path,'/srv/RAID5/dev-disk-by-uuid-342ac512-ae09-47a7-842f-d3158537d395/mnt/Audio/dupes/')
-                        else:
-                            print(file_path + " not a duplicate so far")
-                            file_hashes[audiohash] = file_path
+def createfingerprint(filetofingerprint):
+    print("Fingerprinting " + filetofingerprint)
+    return analyse_audio(filetofingerprint, fingerprint=True)[2]
+
 
 # Function to process files in a directory recursively
-def process_directory(directory):
+def process_directory(directory, state=None):
     i = 0
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            i += 1
-            filepath = os.path.join(dirpath, filename)
-            print("adding " + filepath)
-            toprocess[filepath] = True
+    for record in scan(directory, state, onerror=lambda e: print("Unable to read " + str(e))):
+        i += 1
+        print("adding " + record.path)
+        toprocess[record.path] = record
     print(str(directory) + " has " + str(i) + " files.")
 
-# Initialize dictionaries to store unique and duplicate hashes
+# Initialize dictionary to store unique hashes
 unique_hashes = {}
-duplicate_hashes = {}
 
 #directory = input("Enter the directory path to search for audio files: ")
 #directory = "/srv/RAID5/dev-disk-by-uuid-342ac512-ae09-47a7-842f-d3158537d395/mnt/Audio/forbeets/Albums/Henrik Schwarz/DJ Kicks"
@@ -169,35 +80,54 @@ duplicate_hashes = {}
 directory = "Z:\\Audio\\forbeets\\"
 
 programname = "mp3hasher"
-# Filepath for cache.csv
+# Filepath for the hash cache.  The old cache.csv is imported on first run.
+cache_db = programname + 'cache.db'
 cache_file = programname + 'cache.csv'
+# Hashes are of the decoded PCM, not the file, so keep them apart from file hashes in a shared cache
+hash_algorithm = 'pcm-blake2b-16'
 #cache_file = 'W:\RAID5\dev-disk-by-uuid-342ac512-ae09-47a7-842f-d3158537d395\mnt\cache.csv'
 unique_file = programname + 'unique.csv'
 duplicate_file = programname + 'duplicate_hashes.csv'
 pydub_supported_formats = ['.mp3', '.wav', '.aiff', '.flac', '.m4a', '.ogg', '.aac', '.ac3', '.wma']
 
+# Acoustic fingerprint mode (see audiofingerprint.py).  Also finds the same recording
+# at another bitrate, in another codec or with silence trimmed, which the PCM hash
+# can't.  Fingerprints are cached next to the hashes; groups of files found to be
+# the same recording are added to the duplicates CSV after the exact duplicates.
+fingerprint_mode = False
+fingerprint_algorithm = 'spectral-peaks-v1'
+if fingerprint_mode:
+    from audiofingerprint import Fingerprint, FingerprintIndex
+
+# Optional database of directory mtimes.  Directories unchanged since the last run are
+# not listed again; note a file rewritten in place does not change its directory's mtime.
+scan_state_db = None  # e.g. 'scan_state.db'
+
 # Dictionary to store filepaths to be processed
 toprocess = {}
 
-# Read cache.csv into filehashes dictionary if it exists
-filehashes = {}
-if os.path.exists(cache_file):
-    print("Loading cache")
-    with open(cache_file, 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            filehashes[row[0]] = row[1]
-    print("cache load complete")
+print("Opening cache")
+cache = open_cache(cache_db, cache_file, hash_algorithm)
 
 # Process both directories
 print("Loading files")
-process_directory(directory)
+state = ScanState(scan_state_db) if scan_state_db else None
+process_directory(directory, state)
+if state is not None:
+    state.close()
 
 
-# Remove filepaths from filehashes that are not in toprocess
-print("Removing " + str(len(filehashes)) + " known hashes.")
-filehashes = {k: v for k, v in filehashes.items() if k in toprocess}
-print("Known hashes removed. "  + str(len(toprocess)) + " to do.")
+# Load cached hashes for files that are still present and unchanged
+filehashes = {}
+for filepath, stat_result in toprocess.items():
+    file_hash = cache.get(filepath, stat_result, hash_algorithm)
+    if file_hash is not None:
+        filehashes[filepath] = file_hash
+print("Loaded " + str(len(filehashes)) + " known hashes. "  + str(len(toprocess)) + " to do.")
+# hash -> paths index used to find duplicates
+hashindex = HashIndex(filehashes)
+# Every file's fingerprint, matched against each other once all are in
+fingerprints = FingerprintIndex() if fingerprint_mode else None
 
 
 filetodo = sorted(toprocess.keys(), key=lambda x: (os.path.basename(x), x), reverse=True)
@@ -208,48 +138,39 @@ for filepath in filetodo:
     print(str(i) + " of " + str(len(filetodo)))
 
     if filepath.endswith(tuple(pydub_supported_formats)):
-
+        fingerprint = None
+        if fingerprint_mode:
+            fingerprint_text = cache.get(filepath, toprocess[filepath], fingerprint_algorithm)
+            if fingerprint_text is not None:
+                fingerprint = Fingerprint.decode(fingerprint_text)
+        need_fingerprint = fingerprint_mode and fingerprint is None
+        new_fingerprint = None
 
         if filepath not in filehashes:
-            # Calculate hash for new file
-            file_hash = createhash(filepath)
+            # Hash, metadata and fingerprint for the new file, all from one decode
+            print("Hashing " + filepath)
+            file_hash, audio_info, new_fingerprint = analyse_audio(filepath, need_fingerprint)
 
-
-            result = get_audio_data(filepath)
-            if result is not None:
+            if audio_info is not None and audio_info.has_tags():
                 print("Has metadata")
+                print_audio_info(audio_info)
             else:
                 print("no metadata")
 
-
-
             if file_hash is not None:
-            # Check if hash exists in filehashes
-
-                with open(cache_file, 'w') as csvfile:
-                        writer = csv.writer(csvfile)
-                        for k, v in filehashes.items():
-                            writer.writerow([k, v])
+                print(file_hash + " is hash for " + filepath)
+                cache.put(filepath, toprocess[filepath], file_hash, hash_algorithm)
+                filehashes[filepath] = file_hash
 
-                if file_hash in filehashes.values():
-                    # Find all filepaths with the same hash
-                    duplicate_files = [k for k, v in filehashes.items() if v == file_hash]
+                # Check if other files already have this hash
+                duplicate_files = hashindex.add(filepath, file_hash)
+                if len(duplicate_files) > 1:
                     # Print hash and filepaths
                     print(f"Duplicate hash: {file_hash}")
                     print("Filepaths:")
                     for file in duplicate_files:
                         print(file)
-                    # Add hash and filepath to duplicate_hashes dictionary
-                    duplicate_hashes[file_hash] = duplicate_files
-                    filehashes[filepath] = file_hash
-
-                    with open(duplicate_file, 'w') as csvfile:
-                        writer = csv.writer(csvfile)
-                        for k, v in duplicate_hashes.items():
-                            writer.writerow([k, ', '.join(v)])
-                else:
-                    # Add hash and filepath to filehashes dictionary
-                    filehashes[filepath] = file_hash
+                    hashindex.write_duplicates_csv(duplicate_file)
 
             else:
                 print("bad file " + filepath)
@@ -257,9 +178,31 @@ for filepath in filetodo:
             # Get hash for existing file
             file_hash = filehashes[filepath]
             print("existing hash found and loaded for " + filepath)
+            if need_fingerprint:
+                new_fingerprint = createfingerprint(filepath)
         # Add hash and filepath to unique_hashes dictionary
         unique_hashes[file_hash] = filepath
-        # Write hash and filepath to cache.csv
+
+        if new_fingerprint is not None:
+            cache.put(filepath, toprocess[filepath], new_fingerprint.encode(), fingerprint_algorithm)
+            fingerprint = new_fingerprint
+        if fingerprint is not None:
+            fingerprints.add(filepath, fingerprint)
+
+cache.close()
+hashindex.write_duplicates_csv(duplicate_file, force=True)
+
+if fingerprint_mode:
+    # One row per group of matching files, in the exact duplicates' layout.  The hash
+    # is the PCM hash of the group's first file, the others have hashes of their own.
+    print("Matching " + str(len(fingerprints)) + " fingerprints")
+    with open(duplicate_file, 'a') as csvfile:
+        writer = csv.writer(csvfile)
+        for paths in fingerprints.duplicates():
+            if len({filehashes.get(path) for path in paths}) == 1:
+                continue  # Exact duplicates, already written
+            print("Same recording: " + ", ".join(paths))
+            writer.writerow([filehashes.get(paths[0], ''), ', '.join(paths)])
 
 with open(unique_file, 'w') as csvfile:
     writer = csv.writer(csvfile)
@@ -0,0 +1,115 @@
+import os
+import csv
+import sys
+import time
+
+from hashcache import HashCache
+from progress import ProgressReporter
+from imagetypes import IMAGE_EXTENSIONS
+import perceptualhash
+import scanner
+
+# Finds near-duplicate images under a directory: resized, recompressed or re-exported
+# copies that combo.py's exact pixel hash can't match.  Every image gets a dHash and
+# a pHash (see perceptualhash.py), computed in a process pool and kept in the hash
+# cache, so a re-run only hashes new or changed files.  Images whose hashes are
+# within max_distance bits are joined into clusters, written to the CSV as one row
+# per image: cluster, path, hash, bits from the cluster's first image.
+#
+# usage: python find_similar_images.py <directory> [max distance] [dhash|phash]
+
+cache_db = 'similarimagescache.db'
+cluster_file = 'similar_images.csv'
+hash_kind = 'phash'  # Hash the clusters are built from, 'dhash' or 'phash'
+max_distance = 6  # Bits two 64 bit hashes may differ by and still be near duplicates
+workers = os.cpu_count() or 1
+
+# Perceptual hashes share the cache with file hashes under their own algorithm names
+ALGORITHMS = {'dhash': 'dhash-64', 'phash': 'phash-64'}
+
+# Progress output: seconds between progress lines
+progress_interval = 5
+
+
+def load_hashes(directory, cache):
+    """{path: (dhash, phash)} for every image under directory, hashing what's not cached."""
+    hashes = {}
+    records = {}
+    progress = ProgressReporter(interval=progress_interval)
+
+    def onerror(e):
+        print("Unable to read " + str(e))
+
+    def uncached():
+        # The scanner's records have the size, mtime and inode the cache checks
+        for record in scanner.scan(directory, onerror=onerror, sort=True):
+            if not record.path.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            cached = tuple(cache.get(record.path, record, algorithm) for algorithm in ALGORITHMS.values())
+            if None not in cached:
+                hashes[record.path] = cached
+                progress.file_skipped()
+                continue
+            records[record.path] = record
+            yield record.path
+
+    for path, result, error in perceptualhash.hash_images(uncached(), workers):
+        stat_result = records.pop(path)
+        if error is not None:
+            print("bad file " + path + ". " + str(error))
+            progress.file_failed()
+            continue
+        hashes[path] = result
+        for algorithm, value in zip(ALGORITHMS.values(), result):
+            cache.put(path, stat_result, value, algorithm)
+        progress.file_done(stat_result.st_size, stat_result.st_dev)
+    progress.close()
+    return hashes
+
+
+def find_clusters(hashes, kind=hash_kind, distance=max_distance):
+    """Lists of paths whose kind hashes are near each other, largest first."""
+    column = list(ALGORITHMS).index(kind)
+    paths = sorted(hashes)
+    values = perceptualhash.to_array(hashes[path][column] for path in paths)
+    start = time.perf_counter()
+    i, j, _ = perceptualhash.HammingIndex(values).pairs(distance)
+    groups = perceptualhash.clusters(len(paths), i, j)
+    print("Found " + str(len(i)) + " near pairs in " + str(len(groups)) + " clusters among " + str(len(paths))
+          + " images in " + f"{time.perf_counter() - start:.1f}" + " seconds")
+    return [[paths[k] for k in group] for group in groups]
+
+
+def write_clusters_csv(clusters, hashes, output_file, kind=hash_kind):
+    column = list(ALGORITHMS).index(kind)
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['cluster', 'path', kind, 'distance'])
+        for number, paths in enumerate(clusters, 1):
+            values = perceptualhash.to_array(hashes[path][column] for path in paths)
+            distances = perceptualhash.popcount(values ^ values[0])
+            for path, value, distance in zip(paths, values, distances):
+                writer.writerow([number, path, format(int(value), '016x'), int(distance)])
+    print("Wrote " + str(len(clusters)) + " clusters to " + output_file)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python find_similar_images.py <directory> [max distance] [dhash|phash]")
+        sys.exit(1)
+    directory = os.path.abspath(sys.argv[1])
+    distance = int(sys.argv[2]) if len(sys.argv) > 2 else max_distance
+    kind = sys.argv[3] if len(sys.argv) > 3 else hash_kind
+    if kind not in ALGORITHMS:
+        print("hash must be one of " + ", ".join(ALGORITHMS))
+        sys.exit(1)
+
+    print("Opening cache")
+    with HashCache(cache_db) as cache:
+        hashes = load_hashes(directory, cache)
+    clusters = find_clusters(hashes, kind, distance)
+    write_clusters_csv(clusters, hashes, cluster_file, kind)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,13 @@ import hashlib
 import csv
 import threading
 
-# function to calculate SHA-1 hash of a file
+import hashcore
+
+# function to calculate SHA-1 hash of a file, given its path or an open file object
 def calculate_hash(file_path):
-    sha1_hash = hashlib.sha1()
-    with open(file_path, "rb") as f:
-        while True:
-            data = f.read(1024)
-            if not data:
-                break
-            sha1_hash.update(data)
-    return sha1_hash.hexdigest()
+    if hasattr(file_path, "read"):
+        return hashcore.hash_fileobj(file_path, hashlib.sha1()).hexdigest()
+    return hashcore.hash_file(file_path, "sha1")
 
 # function to process a single archive file
 def process_archive(archive_path, log_file):
@@ -76,4 +73,12 @@ def process_directory(directory):
     with open(log_filename, "w", newline="") as log_file:
         log_writer = csv.writer(log_file)
         log_writer.writerow(["File path", "Archive path", "SHA-1 hash"])
-        for root, _, filenames
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                archive_path = os.path.join(root, filename)
+                if archive_path != log_filename:
+                    process_archive(archive_path, log_writer)
+
+
+if __name__ == "__main__":
+    process_directory(sys.argv[1])
@@ -0,0 +1,131 @@
+import os
+import csv
+import sqlite3
+import time
+
+# Shared hash cache for the duplicate finding scripts.
+#
+# Entries are keyed on (path, size, mtime_ns, inode, algorithm).  A lookup only
+# returns a hash when the file on disk still has the size, mtime and inode it had
+# when it was hashed, so edited or replaced files get hashed again.
+
+COMMIT_EVERY_FILES = 1000  # Commit after this many new hashes
+COMMIT_EVERY_SECONDS = 30  # or after this many seconds, whichever comes first
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    path      TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    inode     INTEGER NOT NULL,
+    hash      TEXT NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+CREATE INDEX IF NOT EXISTS hashes_by_hash ON hashes (algorithm, hash);
+'''
+
+UPSERT = '''
+INSERT INTO hashes (path, algorithm, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (path, algorithm) DO UPDATE SET
+    size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, hash = excluded.hash
+'''
+
+
+class HashCache:
+    def __init__(self, db_path, commit_every=COMMIT_EVERY_FILES, commit_interval=COMMIT_EVERY_SECONDS):
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        # Rows not yet written, keyed like the table so lookups see them
+        self.pending = {}
+        self.last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        self.flush()
+        return self.conn.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+    def get(self, path, stat_result, algorithm='blake2b'):
+        """Return the cached hash for path, or None if unknown or the file has changed."""
+        row = self.pending.get((path, algorithm))
+        if row is None:
+            row = self.conn.execute(
+                'SELECT path, algorithm, size, mtime_ns, inode, hash FROM hashes WHERE path = ? AND algorithm = ?',
+                (path, algorithm)).fetchone()
+        if row is None:
+            return None
+        if (row[2], row[3], row[4]) != (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino):
+            return None
+        return row[5]
+
+    def put(self, path, stat_result, file_hash, algorithm='blake2b'):
+        self.pending[(path, algorithm)] = (path, algorithm, stat_result.st_size, stat_result.st_mtime_ns,
+                                           stat_result.st_ino, file_hash)
+        if len(self.pending) >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany(UPSERT, self.pending.values())
+            self.pending = {}
+        self.last_commit = time.monotonic()
+
+    def forget_missing(self, present_paths, algorithm='blake2b'):
+        """Drop entries for files under this algorithm that are not in present_paths."""
+        self.flush()
+        stale = [(path, algorithm) for (path,) in
+                 self.conn.execute('SELECT path FROM hashes WHERE algorithm = ?', (algorithm,))
+                 if path not in present_paths]
+        with self.conn:
+            self.conn.executemany('DELETE FROM hashes WHERE path = ? AND algorithm = ?', stale)
+        return len(stale)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def import_csv_cache(csv_path, cache, algorithm='blake2b'):
+    """
+    One-shot import of an old path,hash cache.csv.  The CSV holds no stat data, so each
+    file is stat'ed now and the hash is trusted for the file as it currently is.
+    Files that no longer exist are skipped.
+    """
+    imported = 0
+    skipped = 0
+    with open(csv_path, 'r') as csvfile:
+        reader = csv.reader(csvfile)
+        for row in reader:
+            if len(row) < 2:
+                continue
+            try:
+                stat_result = os.stat(row[0])
+            except OSError:
+                skipped += 1
+                continue
+            cache.put(row[0], stat_result, row[1], algorithm)
+            imported += 1
+    cache.flush()
+    print("Imported " + str(imported) + " hashes from " + csv_path + ". Skipped " + str(skipped) + " missing files.")
+    return imported
+
+
+def open_cache(db_path, legacy_csv=None, algorithm='blake2b'):
+    """Open the cache, importing legacy_csv the first time the database is created."""
+    new_db = not os.path.exists(db_path)
+    cache = HashCache(db_path)
+    if new_db and legacy_csv and os.path.exists(legacy_csv):
+        import_csv_cache(legacy_csv, cache, algorithm)
+    return cache
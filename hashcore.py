@@ -0,0 +1,123 @@
+import os
+import mmap
+import hashlib
+import threading
+
+# Shared file hashing core.
+#
+# Reads go through one preallocated bytearray per thread with readinto(), so hashing
+# a file allocates nothing per chunk.  Large regular files can be mmap'ed instead.
+# The kernel is told the file is read sequentially, and pages already hashed are
+# dropped from the page cache so scanning terabytes does not push everything else
+# out of memory.
+
+MB = 1024 * 1024
+BUFFER_SIZE = 1 * MB  # Read size; see benchmarks/bench_hashcore.py
+MMAP_THRESHOLD = 256 * MB  # Files at least this big are mmap'ed when strategy is 'auto'
+
+STRATEGIES = ('auto', 'readinto', 'mmap', 'read')
+
+_local = threading.local()
+
+
+def get_buffer(size=BUFFER_SIZE):
+    """Return this thread's reusable buffer of `size` bytes as a memoryview."""
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+    view = buffers.get(size)
+    if view is None:
+        view = buffers[size] = memoryview(bytearray(size))
+    return view
+
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def hash_fileobj(fileobj, hasher, buffer_size=BUFFER_SIZE):
+    """Feed an open binary file object (e.g. an archive member) into hasher."""
+    view = get_buffer(buffer_size)
+    readinto = getattr(fileobj, 'readinto', None)
+    if readinto is None:
+        while True:
+            chunk = fileobj.read(buffer_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        return hasher
+    while True:
+        n = readinto(view)
+        if not n:
+            break
+        hasher.update(view[:n])
+    return hasher
+
+
+def _hash_readinto(file, hasher, buffer_size, drop_cache):
+    view = get_buffer(buffer_size)
+    offset = 0
+    while True:
+        n = file.readinto(view)
+        if not n:
+            break
+        hasher.update(view[:n])
+        if drop_cache:
+            _fadvise(file.fileno(), offset, n, os.POSIX_FADV_DONTNEED)
+        offset += n
+
+
+def _hash_read(file, hasher, buffer_size, drop_cache):
+    # Allocates a new bytes object per chunk, as the scripts used to.  Kept for comparison.
+    offset = 0
+    while True:
+        chunk = file.read(buffer_size)
+        if not chunk:
+            break
+        hasher.update(chunk)
+        if drop_cache:
+            _fadvise(file.fileno(), offset, len(chunk), os.POSIX_FADV_DONTNEED)
+        offset += len(chunk)
+
+
+def _hash_mmap(file, size, hasher, buffer_size, drop_cache):
+    fd = file.fileno()
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            for offset in range(0, size, buffer_size):
+                hasher.update(view[offset:offset + buffer_size])
+                if drop_cache:
+                    _fadvise(fd, offset, buffer_size, os.POSIX_FADV_DONTNEED)
+
+
+def hash_file(file_path, algorithm='blake2b', buffer_size=BUFFER_SIZE, strategy='auto',
+              drop_cache=True, **hasher_args):
+    """
+    Return the hex digest of file_path.  hasher_args go to the hashlib constructor,
+    e.g. digest_size=16 for blake2b.  drop_cache evicts each chunk from the page cache
+    once it is hashed.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown hashing strategy {strategy}")
+    hasher = hashlib.new(algorithm, **hasher_args)
+    drop_cache = drop_cache and hasattr(os, 'posix_fadvise')
+    # Unbuffered, so readinto() goes straight from the kernel into our buffer
+    with open(file_path, 'rb', buffering=0) as file:
+        size = os.fstat(file.fileno()).st_size
+        if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+            _fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if strategy == 'auto':
+            strategy = 'mmap' if size >= MMAP_THRESHOLD else 'readinto'
+        if strategy == 'mmap' and size > 0:
+            _hash_mmap(file, size, hasher, buffer_size, drop_cache)
+        elif strategy == 'read':
+            _hash_read(file, hasher, buffer_size, drop_cache)
+        else:
+            _hash_readinto(file, hasher, buffer_size, drop_cache)
+    return hasher.hexdigest()
@@ -0,0 +1,63 @@
+import csv
+import time
+
+# Reverse index from hash to the set of paths that have it.
+#
+# The scripts used to find duplicates with `file_hash in filehashes.values()` and a
+# list comprehension over filehashes for every new file, which is a linear scan per
+# file.  HashIndex keeps hash -> paths up to date as files are added so each check is
+# a dict lookup, and remembers which hashes have more than one path.
+
+DUPLICATE_WRITE_SECONDS = 60  # Minimum time between rewrites of the duplicates CSV
+
+
+class HashIndex:
+    def __init__(self, filehashes=None):
+        self.paths_by_hash = {}
+        self.duplicate_hashes = set()
+        self.changed = False
+        self.last_written = 0
+        if filehashes:
+            for filepath, file_hash in filehashes.items():
+                self.add(filepath, file_hash)
+
+    def __len__(self):
+        return len(self.paths_by_hash)
+
+    def __contains__(self, file_hash):
+        return file_hash in self.paths_by_hash
+
+    def add(self, filepath, file_hash):
+        """Record filepath under file_hash and return every path now sharing that hash."""
+        paths = self.paths_by_hash.setdefault(file_hash, {})
+        if filepath not in paths:
+            # A dict rather than a set so paths stay in the order they were found
+            paths[filepath] = None
+            if len(paths) > 1:
+                self.duplicate_hashes.add(file_hash)
+                self.changed = True
+        return list(paths)
+
+    def paths(self, file_hash):
+        return list(self.paths_by_hash.get(file_hash, ()))
+
+    def duplicates(self):
+        """Return hash -> paths for every hash held by more than one path."""
+        return {file_hash: list(self.paths_by_hash[file_hash]) for file_hash in self.duplicate_hashes}
+
+    def write_duplicates_csv(self, output_file, force=False):
+        """
+        Write hash, "path1, path2, ..." rows for every duplicate hash.  Without force
+        the file is only rewritten when a duplicate was found since the last write and
+        DUPLICATE_WRITE_SECONDS have passed, so a run with many duplicates does not
+        spend its time rewriting the CSV.
+        """
+        if not force and (not self.changed or time.monotonic() - self.last_written < DUPLICATE_WRITE_SECONDS):
+            return False
+        with open(output_file, 'w') as csvfile:
+            writer = csv.writer(csvfile)
+            for file_hash, paths in self.duplicates().items():
+                writer.writerow([file_hash, ', '.join(paths)])
+        self.changed = False
+        self.last_written = time.monotonic()
+        return True
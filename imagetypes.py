@@ -0,0 +1,6 @@
+# File extensions of the images the image scripts (combo.py, find_similar_images.py)
+# work on, in one place so both pick up the same files.
+
+#IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff', '.bmp')
+#bmp does not support many tags
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.tif', '.tiff',)
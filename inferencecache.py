@@ -0,0 +1,136 @@
+import time
+import sqlite3
+import threading
+
+import numpy as np
+
+# On disk cache of WD14 results for combo.py.
+#
+# Entries are keyed on what was inferred, not where it lives: (model, pixel hash).
+# The pixel hash is the one exiftool_hash wrote to the file (XMP-et:OriginalImageMD5)
+# when it has one, else a hash of the reduced pixels the model is given.  A file that
+# has been moved, copied or renamed, or has had its metadata rewritten, still has the
+# same pixels and skips the model.  The whole confidence vector is stored, so
+# ratings, tags and the text can be rebuilt with any threshold.  When the cache grows
+# past max_bytes, the least recently used entries are evicted.
+
+MAX_BYTES = 4 * 1024 ** 3  # About 110k images for the vit tagger's ~9k float32 confidences
+COMMIT_EVERY = 256  # Commit after this many new entries or hits
+COMMIT_EVERY_SECONDS = 30  # or after this many seconds, whichever comes first
+EVICT_TO = 0.9  # Evict down to this fraction of max_bytes so we don't evict on every commit
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inference (
+    model      TEXT NOT NULL,
+    pixel_hash TEXT NOT NULL,
+    confidence BLOB NOT NULL,
+    last_used  REAL NOT NULL,
+    PRIMARY KEY (model, pixel_hash)
+);
+CREATE INDEX IF NOT EXISTS inference_by_last_used ON inference (last_used);
+'''
+
+
+class InferenceCache:
+    def __init__(self, db_path, max_bytes=MAX_BYTES, commit_every=COMMIT_EVERY, commit_interval=COMMIT_EVERY_SECONDS):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # Used from the pipeline's decode threads and the batcher thread, always under _lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self._lock = threading.Lock()
+        self.pending = {}  # (model, pixel_hash) -> (confidence blob, last_used) not yet written
+        self.touched = {}  # (model, pixel_hash) -> last_used for hits not yet written
+        self.last_commit = time.monotonic()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(LENGTH(confidence)), 0) FROM inference').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, model, pixel_hash):
+        """Return the cached confidence vector as float32, or None."""
+        key = (model, pixel_hash)
+        with self._lock:
+            row = self.pending.get(key)
+            if row is None:
+                row = self.conn.execute('SELECT confidence FROM inference WHERE model = ? AND pixel_hash = ?', key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+            self._maybe_flush()
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, model, pixel_hash, confidence):
+        blob = np.asarray(confidence, dtype=np.float32).tobytes()
+        with self._lock:
+            self.pending[(model, pixel_hash)] = (blob, time.time())
+            self._maybe_flush()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return ("InferenceCache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, "
+                + f"{self.hit_rate():.1%}" + " hit rate, " + str(self.evicted) + " evicted, "
+                + f"{self.total_bytes / 1024 / 1024:.1f}" + " MB")
+
+    def _maybe_flush(self):
+        if (len(self.pending) + len(self.touched) >= self.commit_every
+                or time.monotonic() - self.last_commit >= self.commit_interval):
+            self._flush()
+
+    def _flush(self):
+        if self.pending or self.touched:
+            with self.conn:
+                for (model, pixel_hash), (blob, last_used) in self.pending.items():
+                    cursor = self.conn.execute('INSERT OR IGNORE INTO inference (model, pixel_hash, confidence, last_used) '
+                                               'VALUES (?, ?, ?, ?)', (model, pixel_hash, blob, last_used))
+                    if cursor.rowcount:
+                        self.total_bytes += len(blob)
+                self.conn.executemany('UPDATE inference SET last_used = ? WHERE model = ? AND pixel_hash = ?',
+                                      [(last_used, model, pixel_hash) for (model, pixel_hash), last_used in self.touched.items()])
+            self.pending = {}
+            self.touched = {}
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        self.last_commit = time.monotonic()
+
+    def _evict(self):
+        target = self.max_bytes * EVICT_TO
+        while self.total_bytes > target:
+            rows = self.conn.execute('SELECT model, pixel_hash, LENGTH(confidence) FROM inference '
+                                     'ORDER BY last_used LIMIT 1000').fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            victims = []
+            for model, pixel_hash, size in rows:
+                victims.append((model, pixel_hash))
+                self.total_bytes -= size
+                if self.total_bytes <= target:
+                    break
+            with self.conn:
+                self.conn.executemany('DELETE FROM inference WHERE model = ? AND pixel_hash = ?', victims)
+            self.evicted += len(victims)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
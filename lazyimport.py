@@ -0,0 +1,35 @@
+import importlib
+
+# Stand-in for a module that is only imported the first time something on it is used,
+# for scripts where some modes never touch a heavy dependency:
+#
+#   np = lazy_module('numpy')
+#   np.zeros(3)  # numpy is imported here
+#
+# Only attribute access is forwarded.  For a name imported with `from x import y`
+# either proxy the submodule (lazy_module('PIL.Image')) or import it inside the
+# function that uses it.
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            # import_module holds the import lock, so threads racing here get the same module
+            module = self.__dict__['_module'] = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return '<lazy module ' + self._name + ' (' + state + ')>'
+
+
+def lazy_module(name):
+    return LazyModule(name)
@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+
+import onnxruntime
+
+# Where combo.py's WD14 model files come from, and how their onnxruntime sessions are
+# set up.
+#
+# Files are looked up in MODEL_DIR, laid out as MODEL_DIR/<repo>/<file>, e.g.
+# models/SmilingWolf/wd-v1-4-vit-tagger-v2/model.onnx, and then in the Hugging Face
+# cache.  Neither touches the network.  A file found in neither is an error unless
+# downloading is switched on with WD14_ALLOW_DOWNLOAD=1, when it's downloaded into
+# MODEL_DIR; so models only ever load offline, from a MODEL_DIR filled by one run
+# with downloading on or copied from another machine.
+#
+# Sessions get explicit thread counts and full graph optimization.  With
+# SAVE_OPTIMIZED the optimized graph is written next to the model the first time and
+# loaded from there afterwards, skipping the optimization passes at startup.  The
+# optimized file is specific to the machine and onnxruntime version that wrote it;
+# delete it after changing either.
+
+logger = logging.getLogger('my_logger')
+
+MODEL_DIR = os.environ.get('WD14_MODEL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models'))
+ALLOW_DOWNLOAD = os.environ.get('WD14_ALLOW_DOWNLOAD', '0') == '1'
+
+INTRA_OP_THREADS = os.cpu_count() or 0  # Threads inside one operator (0 lets onnxruntime decide)
+INTER_OP_THREADS = 1  # Operators run one after another, the graph is a single chain
+SAVE_OPTIMIZED = True
+OPTIMIZED_SUFFIX = '.optimized.onnx'
+
+
+class ModelNotFound(Exception):
+    pass
+
+
+def local_path(repo, filename):
+    return os.path.join(MODEL_DIR, *repo.split('/'), filename)
+
+
+def resolve(repo, filename):
+    """Return a local path for repo's filename, downloading it only as a last resort."""
+    path = local_path(repo, filename)
+    if os.path.isfile(path):
+        return path
+
+    from huggingface_hub import hf_hub_download
+    try:
+        return hf_hub_download(repo, filename=filename, local_files_only=True)
+    except Exception:
+        pass
+
+    if not ALLOW_DOWNLOAD:
+        raise ModelNotFound(filename + " from " + repo + " is not in " + MODEL_DIR
+                            + " or the Hugging Face cache, and WD14_ALLOW_DOWNLOAD is off")
+    logger.info("modelregistry: downloading " + filename + " from " + repo + " to " + os.path.dirname(path))
+    return hf_hub_download(repo, filename=filename, local_dir=os.path.dirname(path))
+
+
+def providers_for(mode):
+    if mode == 'cpu':
+        return ['CPUExecutionProvider']
+    return onnxruntime.get_available_providers()
+
+
+def create_session(repo, model_path, mode='auto'):
+    """
+    InferenceSession for the model at model_path with tuned SessionOptions.
+    InferenceSession.run is thread safe, so one session serves every thread.
+    """
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = INTRA_OP_THREADS
+    options.inter_op_num_threads = INTER_OP_THREADS
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    optimized = local_path(repo, os.path.basename(model_path) + OPTIMIZED_SUFFIX)
+    load_path = model_path
+    if SAVE_OPTIMIZED:
+        if os.path.isfile(optimized) and os.path.getmtime(optimized) >= os.path.getmtime(model_path):
+            load_path = optimized
+        else:
+            os.makedirs(os.path.dirname(optimized), exist_ok=True)
+            # Layout optimizations can't always be saved as ONNX, so save up to extended
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+            options.optimized_model_filepath = optimized
+
+    start = time.perf_counter()
+    session = onnxruntime.InferenceSession(str(load_path), sess_options=options, providers=providers_for(mode))
+    logger.info("modelregistry: loaded " + str(load_path) + " in " + f"{time.perf_counter() - start:.2f}"
+                + " seconds with " + ", ".join(session.get_providers()))
+    return session
@@ -0,0 +1,85 @@
+import os
+import concurrent.futures
+from collections import deque
+
+import hashcore
+
+# Parallel file hashing, scheduled per device.
+#
+# Files are grouped by st_dev and each device gets its own limit on concurrent reads,
+# so two disks are read at the same time but a spinning disk is never asked to seek
+# between several files at once.  Hashing runs in a process pool and results are
+# yielded as they finish so the caller can put them straight into the cache.
+
+ROTATIONAL_WORKERS = 1  # One sequential reader per spinning disk
+SSD_WORKERS = 4  # Concurrent readers per SSD / NVMe device
+UNKNOWN_WORKERS = 1  # Network shares, FUSE (mergerfs) and anything else we can't identify
+
+
+def is_rotational(dev):
+    """True for a spinning disk, False for SSD, None if it can't be told (non-Linux, FUSE, network)."""
+    if not hasattr(os, 'major'):
+        return None
+    base = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+    # Partitions don't have a queue directory of their own, their parent disk does
+    for queue in (os.path.join(base, 'queue', 'rotational'), os.path.join(base, '..', 'queue', 'rotational')):
+        try:
+            with open(queue) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            pass
+    return None
+
+
+def device_workers(dev, overrides=None):
+    if overrides and dev in overrides:
+        return overrides[dev]
+    rotational = is_rotational(dev)
+    if rotational is None:
+        return UNKNOWN_WORKERS
+    return ROTATIONAL_WORKERS if rotational else SSD_WORKERS
+
+
+class ParallelHasher:
+    def __init__(self, workers_per_device=None, buffer_size=hashcore.BUFFER_SIZE):
+        # workers_per_device maps st_dev -> worker count and overrides detection
+        self.workers_per_device = workers_per_device or {}
+        self.buffer_size = buffer_size
+
+    def hash_files(self, files):
+        """
+        Hash (filepath, stat_result) pairs.  Yields (filepath, file_hash, error) as each
+        file finishes; file_hash is None and error is the exception if it failed.
+        Within a device, files are started in the order given.
+        """
+        queues = {}
+        for filepath, stat_result in files:
+            queues.setdefault(stat_result.st_dev, deque()).append(filepath)
+        if not queues:
+            return
+
+        limits = {dev: max(1, device_workers(dev, self.workers_per_device)) for dev in queues}
+        for dev, limit in limits.items():
+            print("Device " + str(dev) + ": " + str(len(queues[dev])) + " files, " + str(limit) + " workers")
+
+        in_flight = {dev: 0 for dev in queues}
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=sum(limits.values())) as pool:
+            def fill(dev):
+                while queues[dev] and in_flight[dev] < limits[dev]:
+                    filepath = queues[dev].popleft()
+                    running[pool.submit(hashcore.hash_file, filepath, buffer_size=self.buffer_size)] = (dev, filepath)
+                    in_flight[dev] += 1
+
+            for dev in queues:
+                fill(dev)
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dev, filepath = running.pop(future)
+                    in_flight[dev] -= 1
+                    fill(dev)
+                    try:
+                        yield filepath, future.result(), None
+                    except Exception as e:
+                        yield filepath, None, e
@@ -0,0 +1,209 @@
+import itertools
+
+import numpy as np
+from PIL import Image
+
+import pixelhash
+
+# Perceptual hashes for finding near-duplicate images, and an index that finds every
+# pair of hashes within a Hamming distance without comparing all pairs.
+#
+# pixelhash only matches identical pixels.  A resized, recompressed or re-exported
+# copy of a photo has different pixels but nearly the same 64 bit dHash and pHash:
+#   dHash - brightness gradients between neighbouring pixels of a 9x8 grey thumbnail
+#   pHash - low frequency DCT coefficients of a 32x32 grey thumbnail vs their median
+# Two images are near duplicates when their hashes differ in at most a few bits.
+#
+# HammingIndex is multi-index hashing: each hash is split into CHUNKS equal bit
+# ranges.  If two hashes are within d bits, one of their chunks is within
+# d // CHUNKS bits, so only hashes whose chunk matches one of the few nearby chunk
+# values are compared.  Those lookups run as sorted array searches in NumPy, one
+# pass per chunk and per chunk bit flip.
+
+HASH_SIZE = 8  # 8x8 = 64 bit hashes
+PHASH_SCALE = 4  # pHash's DCT runs over a (HASH_SIZE * PHASH_SCALE) pixel square
+DRAFT_SIZE = 256  # JPEGs are decoded at a reduced scale no smaller than this
+
+CHUNKS = 4  # Bit ranges per hash in HammingIndex, 64 must divide by it
+BLOCK_PAIRS = 4_000_000  # Candidate pairs compared per NumPy step, bounds memory
+
+# EXIF orientation -> transpose that shows the image upright, as ImageOps.exif_transpose
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n):
+    # Orthonormal DCT-II, so matrix @ x @ matrix.T is the 2D DCT of x
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(HASH_SIZE * PHASH_SCALE)
+
+
+def _to_hex(bits):
+    return np.packbits(bits.ravel()).tobytes().hex()
+
+
+def _grey(image, size):
+    return np.asarray(image.resize(size, Image.Resampling.LANCZOS), dtype=np.float32)
+
+
+def upright_grey(image):
+    """image as greyscale, turned the way its EXIF orientation says it's shown."""
+    orientation = image.getexif().get(0x0112)
+    image.draft('L', (DRAFT_SIZE, DRAFT_SIZE))
+    image = image.convert('L')
+    if orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return image
+
+
+def dhash(grey):
+    """64 bit difference hash of a greyscale PIL image, as 16 hex digits."""
+    pixels = _grey(grey, (HASH_SIZE + 1, HASH_SIZE))
+    return _to_hex(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(grey):
+    """64 bit DCT hash of a greyscale PIL image, as 16 hex digits."""
+    size = HASH_SIZE * PHASH_SCALE
+    pixels = _grey(grey, (size, size))
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    return _to_hex(low > np.median(low))
+
+
+def hash_image(path):
+    """(dhash, phash) of the image file at path.  Picklable for pixelhash.hash_images."""
+    with Image.open(path) as image:
+        grey = upright_grey(image)
+    return dhash(grey), phash(grey)
+
+
+def hash_images(paths, workers=pixelhash.WORKERS, window=None):
+    """Yields (path, (dhash, phash), error) from a process pool, see pixelhash.hash_images."""
+    return pixelhash.hash_images(paths, workers, window, func=hash_image)
+
+
+def to_array(hex_hashes):
+    return np.array([int(h, 16) for h in hex_hashes], dtype=np.uint64)
+
+
+def popcount(values):
+    """Set bits in each of a uint64 array's values."""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):  # NumPy 2
+        return np.bitwise_count(values).astype(np.int64)
+    return _POPCOUNT8[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def _flips(bits, radius):
+    # Every bits wide mask with at most radius bits set
+    for r in range(radius + 1):
+        for positions in itertools.combinations(range(bits), r):
+            yield sum(1 << p for p in positions)
+
+
+class HammingIndex:
+    def __init__(self, hashes, chunks=CHUNKS):
+        if 64 % chunks:
+            raise ValueError("chunks must divide 64, not " + str(chunks))
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        self.chunks = chunks
+        self.bits = 64 // chunks
+        mask = np.uint64((1 << self.bits) - 1)
+        # Per chunk: its value for every hash, and the hash indexes sorted by it
+        self.tables = []
+        for c in range(chunks):
+            keys = ((self.hashes >> np.uint64(c * self.bits)) & mask).astype(np.int64)
+            order = np.argsort(keys, kind='stable')
+            self.tables.append((keys, order, keys[order]))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def pairs(self, max_distance, block_pairs=BLOCK_PAIRS):
+        """
+        Every pair of hashes at most max_distance bits apart, as (i, j, distance) arrays
+        of hash indexes with i < j.
+        """
+        radius = max_distance // self.chunks
+        found = []
+        for keys, order, sorted_keys in self.tables:
+            for flip in _flips(self.bits, radius):
+                if flip == 0:
+                    # Same chunk value: each hash against the ones after it in sorted order
+                    queries = order
+                    lo = np.arange(1, len(order) + 1)
+                    hi = np.searchsorted(sorted_keys, sorted_keys, 'right')
+                else:
+                    # Chunk values k and k ^ flip: asked from the smaller one only
+                    targets = keys ^ flip
+                    queries = np.flatnonzero(keys < targets)
+                    lo = np.searchsorted(sorted_keys, targets[queries], 'left')
+                    hi = np.searchsorted(sorted_keys, targets[queries], 'right')
+                found.extend(self._compare(queries, lo, hi, order, max_distance, block_pairs))
+        if not found:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        i, j, distance = (np.concatenate(columns) for columns in zip(*found))
+        # A pair close in several chunks was found once per chunk
+        _, first = np.unique(i * len(self.hashes) + j, return_index=True)
+        return i[first], j[first], distance[first]
+
+    def _compare(self, queries, lo, hi, order, max_distance, block_pairs):
+        # Hash queries[k] is paired with every index in order[lo[k]:hi[k]], each pair
+        # coming up once.  Expands those ranges a block of queries at a time and keeps
+        # the pairs within max_distance.
+        counts = hi - lo
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(counts):
+            base = ends[start - 1] if start else 0
+            stop = max(int(np.searchsorted(ends, base + block_pairs, 'right')), start + 1)
+            block_counts = counts[start:stop]
+            total = int(block_counts.sum())
+            if total:
+                i = np.repeat(queries[start:stop], block_counts)
+                offsets = np.arange(total) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+                j = order[np.repeat(lo[start:stop], block_counts) + offsets]
+                i, j = np.minimum(i, j), np.maximum(i, j)
+                distance = popcount(self.hashes[i] ^ self.hashes[j])
+                near = distance <= max_distance
+                yield i[near], j[near], distance[near]
+            start = stop
+
+
+def clusters(count, i, j):
+    """
+    Groups of the count hash indexes joined by pairs (i[k], j[k]), largest first.  A
+    group holds everything reachable through near pairs, so a chain of small edits can
+    join images further apart than the distance used.  Unpaired indexes are left out.
+    """
+    parent = list(range(count))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    groups = {}
+    for x in sorted(set(i.tolist()) | set(j.tolist())):
+        groups.setdefault(find(x), []).append(x)
+    return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import concurrent.futures
+
+from PIL import Image
+
+# Pixel hashing for combo.py's hash mode.
+#
+# The digest is blake2b over the image's pixels as 8 bit RGB, row by row from the
+# top.  It depends only on the pixels: the same picture saved as PNG, TIFF or
+# lossless WebP, or with different metadata, hashes the same.  It is the digest
+# exiftool_hash has always written, so files hashed before keep matching.
+#
+# Images stored as uncompressed rows (uncompressed TIFF, BMP, PPM/PGM, ...) are
+# decoded a strip of rows at a time, each strip read from its own offset in the file,
+# so peak memory is one strip whatever the image size.  Pillow decodes everything
+# else (PNG, JPEG, compressed TIFF, GIF, WebP) as a single tile, so those are decoded
+# whole, then converted to RGB and hashed a strip at a time: peak memory is the
+# decoded image plus one strip, rather than the decoded image plus a full RGB copy
+# plus a bytes copy of that.  Hashing runs in a process pool, as decoding and
+# converting are mostly CPU bound Python-side work.
+
+ROWS = 256  # Rows converted and hashed at a time
+WORKERS = os.cpu_count() or 1
+
+
+def _update(hasher, strip):
+    if strip.mode != 'RGB':
+        strip = strip.convert('RGB')
+    hasher.update(strip.tobytes())
+
+
+def hash_pixels(image, rows=ROWS):
+    """Hex digest of an open PIL image's RGB pixels."""
+    hasher = hashlib.blake2b()
+    width, height = image.size
+    for top in range(0, height, rows):
+        # crop loads the image the first time, there's no need to load it up front
+        _update(hasher, image.crop((0, top, width, min(top + rows, height))))
+    return hasher.hexdigest()
+
+
+def _row_layout(image):
+    """
+    (rawmode, offset, stride, ystep) of an unloaded PIL image whose pixels are stored
+    as uncompressed rows in one block of the file, or None if it's stored any other way.
+    ystep is 1 for rows stored top down and -1 for bottom up.
+    """
+    if len(image.tile) != 1:
+        return None
+    codec, extents, offset, args = image.tile[0]
+    if codec != 'raw' or tuple(extents) != (0, 0) + image.size:
+        return None
+    # Pillow turns TIFFs upright as they load, rows in the file aren't rows of the image
+    if image.getexif().get(0x0112, 1) != 1:
+        return None
+    if isinstance(args, str):
+        args = (args,)
+    rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+    if ystep not in (1, -1):
+        return None
+    if stride <= 0:
+        if rawmode != image.mode:
+            return None
+        # Rows in the image's own mode are packed the way tobytes packs them
+        stride = len(Image.new(image.mode, (image.size[0], 1)).tobytes())
+    return rawmode, offset, stride, ystep
+
+
+def _row_strips(path, layout, size, rows):
+    # Each strip is decoded from its own rows of the file, by reopening it and
+    # narrowing the size and tile to the strip before it's loaded
+    rawmode, offset, stride, ystep = layout
+    width, height = size
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        first_row = top if ystep == 1 else height - bottom
+        with Image.open(path) as strip:
+            strip._size = (width, bottom - top)
+            if hasattr(strip, '_tile_size'):  # TIFF allocates its image from this
+                strip._tile_size = strip._size
+            strip.tile = [('raw', (0, 0, width, bottom - top), offset + first_row * stride,
+                                          (rawmode, stride, ystep))]
+            strip.load()
+            yield strip
+
+
+def hash_image(path, rows=ROWS):
+    """Hex digest of the RGB pixels of the image file at path."""
+    with Image.open(path) as image:
+        layout = _row_layout(image)
+        if layout is None:
+            return hash_pixels(image, rows)
+        size = image.size
+    hasher = hashlib.blake2b()
+    for strip in _row_strips(path, layout, size, rows):
+        _update(hasher, strip)
+    return hasher.hexdigest()
+
+
+def hash_images(paths, workers=WORKERS, window=None, func=hash_image):
+    """
+    Hash image files in a process pool.  Yields (path, digest, error) as each finishes;
+    digest is None and error the exception if it failed.  At most window files are
+    queued at once, so paths can be a generator over a huge tree.  func(path) computes
+    the digest, hash_image unless given another module level function.
+    """
+    window = window or 4 * workers
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        def finished(done):
+            for future in done:
+                path = running.pop(future)
+                try:
+                    yield path, future.result(), None
+                except Exception as e:
+                    yield path, None, e
+
+        for path in paths:
+            while len(running) >= window:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from finished(done)
+            running[pool.submit(func, path)] = path
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from finished(done)
@@ -0,0 +1,134 @@
+import os
+import time
+import sqlite3
+import threading
+
+# What combo.py has already done to each image, so a re-run can skip finished files
+# from their stat data alone, without asking exiftool.
+#
+# Rows are keyed on path and only count while the file still has the size and mtime
+# recorded with them; a file that was replaced or edited is new again.  combo.py's
+# exiftool writes all use -P, which keeps the mtime, so when a file is marked again
+# with its mtime unchanged (e.g. hashed after being tagged) the outcomes add up
+# rather than replace each other.  Marks are recorded with the file's stat taken
+# after the write that produced them.
+
+TAGGED = 1  # WD14 tags written and marked XMP-acdsee:tagged
+HASHED = 2  # Pixel hash written (exiftool_hash, write_pixel_hashes)
+PERSON_TAGGED = 4  # Person/<parent folder> tag written
+BAD_FILE = 8  # Couldn't be opened as an image, recorded at its absolute path in badfiles/
+
+OUTCOMES = {'tagged': TAGGED, 'hashed': HASHED, 'person-tagged': PERSON_TAGGED, 'bad-file': BAD_FILE}
+
+COMMIT_EVERY_FILES = 1000  # Commit after this many marks
+COMMIT_EVERY_SECONDS = 30  # or after this many seconds, whichever comes first
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    outcomes INTEGER NOT NULL,
+    updated  REAL NOT NULL
+);
+'''
+
+
+def describe(outcomes):
+    return ', '.join(name for name, flag in OUTCOMES.items() if outcomes & flag) or 'nothing'
+
+
+class ProcessingState:
+    def __init__(self, db_path, commit_every=COMMIT_EVERY_FILES, commit_interval=COMMIT_EVERY_SECONDS):
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # Marked from worker threads and read from the scanning thread, always under _lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self._lock = threading.Lock()
+        # Rows not yet written, keyed by path so lookups see them
+        self.pending = {}
+        self.last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _row(self, path):
+        row = self.pending.get(path)
+        if row is None:
+            row = self.conn.execute('SELECT path, size, mtime_ns, outcomes, updated FROM files WHERE path = ?',
+                                    (path,)).fetchone()
+        return row
+
+    def get(self, path, stat_result):
+        """Outcomes recorded for path, or 0 if it's unknown or has changed since."""
+        with self._lock:
+            row = self._row(path)
+        if row is None or (row[1], row[2]) != (stat_result.st_size, stat_result.st_mtime_ns):
+            return 0
+        return row[3]
+
+    def has(self, path, stat_result, outcomes):
+        """True if every outcome in the outcomes flags is recorded for the file as it is now."""
+        return self.get(path, stat_result) & outcomes == outcomes
+
+    def mark(self, path, outcome, stat_result=None):
+        """Record outcome for path.  stat_result defaults to the file as it is now."""
+        if stat_result is None:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return
+        with self._lock:
+            row = self._row(path)
+            outcomes = outcome
+            if row is not None and row[2] == stat_result.st_mtime_ns:
+                outcomes |= row[3]
+            self.pending[path] = (path, stat_result.st_size, stat_result.st_mtime_ns, outcomes, time.time())
+            self._maybe_flush()
+
+    def set(self, path, stat_result, outcomes):
+        """Replace whatever is recorded for path, e.g. when rebuilding from the files' metadata."""
+        with self._lock:
+            self.pending[path] = (path, stat_result.st_size, stat_result.st_mtime_ns, outcomes, time.time())
+            self._maybe_flush()
+
+    def forget(self, path):
+        with self._lock:
+            self.pending.pop(path, None)
+            with self.conn:
+                self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def counts(self):
+        """{outcome name: files} over everything recorded."""
+        self.flush()
+        with self._lock:
+            return {name: self.conn.execute('SELECT COUNT(*) FROM files WHERE outcomes & ?', (flag,)).fetchone()[0]
+                    for name, flag in OUTCOMES.items()}
+
+    def _maybe_flush(self):
+        if len(self.pending) >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO files (path, size, mtime_ns, outcomes, updated) '
+                                      'VALUES (?, ?, ?, ?, ?)', list(self.pending.values()))
+            self.pending = {}
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,120 @@
+import sys
+import json
+import time
+
+# Low overhead progress reporting for the hashing scripts.
+#
+# Hashing loops call file_done() once per file, which only updates counters and
+# checks the clock.  At most once every `interval` seconds a single aggregate line is
+# printed (files/s, MB/s per device, ETA) and, if a metrics file is given, the same
+# numbers are appended to it as a JSON line.
+
+REPORT_INTERVAL_SECONDS = 5
+
+MB = 1024 * 1024
+
+
+class ProgressReporter:
+    def __init__(self, total_files=None, total_bytes=None, interval=REPORT_INTERVAL_SECONDS,
+                 quiet=False, metrics_file=None, stream=sys.stdout):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.quiet = quiet
+        self.stream = stream
+        self.metrics = open(metrics_file, 'a') if metrics_file else None
+
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failed = 0
+        self.device_bytes = {}
+        self.start = time.monotonic()
+        self.last_report = self.start
+        # Counters as they were at the last report, for per-interval rates
+        self.last_files = 0
+        self.last_device_bytes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def file_done(self, nbytes, device=None):
+        self.files += 1
+        self.bytes += nbytes
+        self.device_bytes[device] = self.device_bytes.get(device, 0) + nbytes
+        self.tick()
+
+    def file_skipped(self):
+        self.skipped += 1
+        self.tick()
+
+    def file_failed(self):
+        self.failed += 1
+        self.tick()
+
+    def tick(self):
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.report(now)
+
+    def snapshot(self, now):
+        elapsed = now - self.start
+        window = max(now - self.last_report, 1e-9)
+        record = {
+            'time': time.time(),
+            'elapsed': round(elapsed, 3),
+            'files': self.files,
+            'bytes': self.bytes,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'files_per_s': round((self.files - self.last_files) / window, 2),
+            'mb_per_s': {str(dev): round((b - self.last_device_bytes.get(dev, 0)) / MB / window, 2)
+                         for dev, b in self.device_bytes.items()},
+            'eta': None,
+        }
+        if elapsed > 0:
+            # Prefer bytes for the ETA, big files dominate the run time
+            if self.total_bytes and self.bytes:
+                record['eta'] = round((self.total_bytes - self.bytes) / (self.bytes / elapsed))
+            elif self.total_files and self.files:
+                done = self.files + self.skipped + self.failed
+                record['eta'] = round((self.total_files - done) / (done / elapsed))
+        return record
+
+    def report(self, now=None):
+        now = time.monotonic() if now is None else now
+        record = self.snapshot(now)
+        self.last_report = now
+        self.last_files = self.files
+        self.last_device_bytes = dict(self.device_bytes)
+
+        if self.metrics:
+            self.metrics.write(json.dumps(record) + '\n')
+            self.metrics.flush()
+        if not self.quiet:
+            done = self.files + self.skipped + self.failed
+            line = f"{done}"
+            if self.total_files:
+                line += f" of {self.total_files}"
+            line += f" files.  {record['files_per_s']:.1f} files/s."
+            for dev, rate in record['mb_per_s'].items():
+                line += f"  dev {dev}: {rate:.1f} MB/s."
+            if self.skipped or self.failed:
+                line += f"  {self.skipped} skipped, {self.failed} failed."
+            if record['eta'] is not None:
+                line += f"  ETA {record['eta'] // 3600}h{record['eta'] % 3600 // 60:02d}m"
+            print(line, file=self.stream)
+        return record
+
+    def close(self):
+        self.report()
+        elapsed = time.monotonic() - self.start
+        if not self.quiet:
+            print(f"Hashed {self.files} files, {self.bytes / MB:.2f} MB in {elapsed:.2f} seconds. "
+                  f"{self.skipped} skipped, {self.failed} failed.", file=self.stream)
+        if self.metrics:
+            self.metrics.close()
+            self.metrics = None
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import sqlite3
+from collections import namedtuple
+
+# Directory scanner shared by the hashing scripts.
+#
+# Built on os.scandir so the stat data comes from the DirEntry rather than another
+# os.stat/os.path.getsize per file.  scan() is a generator, so callers can start work
+# before the walk finishes.
+#
+# With a state database, each directory's mtime is stored along with its files and
+# subdirectories.  On the next run a directory whose mtime has not changed is not
+# listed again and its files are not stat'ed: the stored records are yielded instead.
+# A directory's mtime changes when entries are added, removed or renamed, but not
+# when a file's contents are rewritten in place.  Only use a state database where
+# that is acceptable, e.g. media libraries where files are added and removed but not
+# edited.
+
+# Record with stat_result style names so it can be passed anywhere a stat_result is
+# used for size / mtime / inode / device (HashCache, ParallelHasher).
+FileRecord = namedtuple('FileRecord', 'path st_size st_mtime_ns st_ino st_dev')
+
+# Directories modified this recently are not trusted, their mtime may not have ticked
+# over for a change made in the same instant we read it
+RACY_SECONDS = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path     TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs  TEXT NOT NULL,
+    files    TEXT NOT NULL
+);
+'''
+
+
+class ScanState:
+    def __init__(self, db_path, commit_every=1000):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.commit_every = commit_every
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, dirpath, mtime_ns):
+        """Return (subdirs, files) stored for dirpath if its mtime is unchanged, else None."""
+        row = self.conn.execute('SELECT mtime_ns, subdirs, files FROM dirs WHERE path = ?', (dirpath,)).fetchone()
+        if row is None or row[0] != mtime_ns:
+            return None
+        return json.loads(row[1]), [FileRecord(*f) for f in json.loads(row[2])]
+
+    def put(self, dirpath, mtime_ns, subdirs, files):
+        self.pending.append((dirpath, mtime_ns, json.dumps(subdirs), json.dumps([list(f) for f in files])))
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def forget(self, dirpath):
+        self.flush()
+        with self.conn:
+            self.conn.execute('DELETE FROM dirs WHERE path = ?', (dirpath,))
+
+    def flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO dirs (path, mtime_ns, subdirs, files) VALUES (?, ?, ?, ?)',
+                                      self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def _list_directory(dirpath, onerror):
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    # Like os.walk: don't descend into symlinked directories, but do
+                    # report symlinked files with the target's stat
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files.append(FileRecord(entry.path, st.st_size, st.st_mtime_ns,
+                                                st.st_ino or entry.inode(), st.st_dev))
+                except OSError as e:
+                    if onerror is not None:
+                        onerror(e)
+    except OSError as e:
+        if onerror is not None:
+            onerror(e)
+        return None
+    return subdirs, files
+
+
+def scan(directory, state=None, onerror=None, sort=False):
+    """
+    Yield a FileRecord for every regular file under directory.  state is an optional
+    ScanState; directories whose mtime it already knows are answered from it.  With
+    sort, each directory's files and subdirectories are taken in name order, so the
+    walk is ordered without collecting and sorting every path first.
+    """
+    stack = [directory]
+    racy_after = time.time_ns() - RACY_SECONDS * 1_000_000_000
+    try:
+        while stack:
+            dirpath = stack.pop()
+            listing = None
+            mtime_ns = None
+            if state is not None:
+                try:
+                    mtime_ns = os.stat(dirpath).st_mtime_ns
+                except OSError as e:
+                    if onerror is not None:
+                        onerror(e)
+                    state.forget(dirpath)
+                    continue
+                listing = state.get(dirpath, mtime_ns)
+            if listing is None:
+                listing = _list_directory(dirpath, onerror)
+                if listing is None:
+                    continue
+                if state is not None and mtime_ns < racy_after:
+                    state.put(dirpath, mtime_ns, *listing)
+            subdirs, files = listing
+            if sort:
+                subdirs, files = sorted(subdirs), sorted(files)
+            yield from files
+            # Reversed so the stack pops subdirectories in listing order
+            stack.extend(reversed(subdirs))
+    finally:
+        if state is not None:
+            state.flush()